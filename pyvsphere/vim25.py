@@ -16,11 +16,93 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import hashlib
 import logging
 import httplib
+import os
+import random
+import re
+import threading
 import time
 import suds
+import suds.builder
+import suds.cache
+import suds.transport
 import urllib2
+from StringIO import StringIO
+
+try:
+    import requests
+    import requests.adapters
+except ImportError:
+    requests = None
+
+# Parsed WSDL/XSD objects are cached here across processes
+DEFAULT_CACHE_DIR = '/var/cache/pyvsphere/suds'
+
+# How long the API version of a server is remembered in the cache
+# directory before it is checked again, so that upgrades are noticed
+API_VERSION_CACHE_SECONDS = 24 * 3600
+
+# Number of levels of child objects create_object() materializes
+DEFAULT_BUILDER_DEPTH = 4
+
+# Properties fetched by Vim.update_many_objects() per object type
+DEFAULT_UPDATE_PROPERTIES = (('Task', ['info']),
+                             ('VirtualMachine', ['name', 'summary']))
+TASK_UPDATE_PROPERTIES = (('Task', ['info']),)
+
+# Longest time WaitForUpdatesEx is let block on the server, kept well
+# below the 90 second default timeout of the SOAP transport
+MAX_WAIT_SECONDS = 60
+
+# Name of the cookie the vSphere server keeps the login session in
+SESSION_COOKIE = 'vmware_soap_session'
+
+# Description of the traversal specs needed to walk the whole
+# inventory. Yes, this is magic. Each entry is a tuple of
+# (name, type, path, names of the selection specs to follow).
+_TRAVERSAL_TEMPLATE = (
+    ('rp_to_rp', 'ResourcePool', 'resourcePool', ('rp_to_rp', 'rp_to_vm')),
+    ('rp_to_vm', 'ResourcePool', 'vm', ()),
+    ('cr_to_rp', 'ComputeResource', 'resourcePool', ('rp_to_rp', 'rp_to_vm')),
+    ('cr_to_ds', 'ComputeResource', 'datastore', ()),
+    ('cr_to_h', 'ComputeResource', 'host', ()),
+    ('dc_to_hf', 'Datacenter', 'hostFolder', ('f_to_f',)),
+    ('dc_to_vmf', 'Datacenter', 'vmFolder', ('f_to_f',)),
+    ('dc_to_nf', 'Datacenter', 'networkFolder', ('f_to_f',)),
+    ('dc_to_dsf', 'Datacenter', 'datastoreFolder', ('f_to_f',)),
+    ('h_to_vm', 'HostSystem', 'vm', ('f_to_f',)),
+    ('f_to_f', 'Folder', 'childEntity', ('f_to_f', 'dc_to_hf', 'dc_to_vmf',
+                                         'dc_to_nf', 'dc_to_dsf', 'cr_to_h',
+                                         'cr_to_ds', 'cr_to_rp', 'h_to_vm',
+                                         'rp_to_vm')),
+    )
+
+# Subtypes that the property collector returns when asked for their
+# parent type
+_PARENT_TYPES = {
+    'ClusterComputeResource': 'ComputeResource',
+    'VirtualApp': 'ResourcePool',
+    'StoragePod': 'Folder',
+    'DistributedVirtualPortgroup': 'Network',
+    'VmwareDistributedVirtualSwitch': 'DistributedVirtualSwitch',
+    }
+
+# The traversal specs only depend on the WSDL, so they are built once per
+# server URL and shared by all the Vim instances of the process
+_traversal_specs_cache = {}
+
+_UUID_RE = re.compile(r'^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$')
+
+# Prefixes of the methods that only read from the server
+_IDEMPOTENT_PREFIXES = ('Retrieve', 'ContinueRetrieve', 'Find', 'WaitForUpdates')
+
+# Errors after which the connection to the server is usable again
+if requests:
+    _CONNECTION_ERRORS = (httplib.BadStatusLine, requests.ConnectionError)
+else:
+    _CONNECTION_ERRORS = (httplib.BadStatusLine,)
 
 class TimeoutError(Exception):
     pass
@@ -34,16 +116,170 @@ class TaskFailedError(Exception):
 class InvalidParameterError(Exception):
     pass
 
+def _cache_location(path):
+    """ Return path if it can be used as a cache directory, None otherwise """
+    if not path:
+        return None
+    try:
+        if not os.path.isdir(path):
+            os.makedirs(path)
+    except OSError:
+        return None
+    return path if os.access(path, os.W_OK) else None
+
+def _api_version_file(cache_dir, url):
+    return os.path.join(cache_dir, 'api-version-%s' % hashlib.md5(url).hexdigest())
+
+def _cached_api_version(cache_dir, url):
+    """ Return the API version remembered for the server or None if there is no recent one """
+    path = _api_version_file(cache_dir, url)
+    try:
+        if time.time() - os.path.getmtime(path) < API_VERSION_CACHE_SECONDS:
+            with open(path) as f:
+                return f.read().strip() or None
+    except (IOError, OSError):
+        pass
+    return None
+
+def _save_api_version(cache_dir, url, api_version):
+    """ Remember the API version of the server for the next clients """
+    try:
+        with open(_api_version_file(cache_dir, url), 'w') as f:
+            f.write(api_version)
+    except (IOError, OSError):
+        pass
+
+_VIM25_VERSION_RE = re.compile(r'<name>\s*urn:vim25\s*</name>\s*<version>\s*([^<\s]+)\s*</version>')
+
+def _server_api_version(url, session=None):
+    """
+    Return the vim25 API version of the server or None if it cannot be told
+
+    @param url: URL to the vSphere server (eg.: https://foosphere/sdk)
+    @param session: requests session to use, urllib2 is used without one
+    """
+    versions_url = url + '/vimServiceVersions.xml'
+    try:
+        if session is not None:
+            content = session.get(versions_url, timeout=30).content
+        else:
+            content = urllib2.urlopen(versions_url, timeout=30).read()
+    except Exception:
+        return None
+    match = _VIM25_VERSION_RE.search(content)
+    return match.group(1) if match else None
+
+class KeepAliveTransport(suds.transport.Transport):
+    """
+    suds transport that keeps the HTTP(S) connection to the server open
+    between the SOAP calls instead of reconnecting for each of them
+
+    @note: requires the 'requests' package
+    """
+    def __init__(self, pool_connections=8, pool_maxsize=16):
+        """
+        @param pool_connections: number of hosts to keep connections to, the
+                                 session is also used for guest file uploads
+                                 which go to the ESX hosts directly
+        @param pool_maxsize: number of connections to keep open per host
+        """
+        suds.transport.Transport.__init__(self)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_connections,
+                                                pool_maxsize=pool_maxsize, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers['Connection'] = 'keep-alive'
+
+    def _proxies(self):
+        """ Return the suds proxy option in the form requests wants it, None for no proxy """
+        proxies = {}
+        for scheme, proxy in (self.options.proxy or {}).items():
+            # suds takes plain host:port, requests needs a URL
+            if '://' not in proxy:
+                proxy = 'http://' + proxy
+            proxies[scheme] = proxy
+        return proxies or None
+
+    def open(self, request):
+        response = self.session.get(request.url, headers=request.headers,
+                                    timeout=self.options.timeout, proxies=self._proxies())
+        if response.status_code >= 400:
+            raise suds.transport.TransportError(response.reason, response.status_code,
+                                                StringIO(response.content))
+        return StringIO(response.content)
+
+    def send(self, request):
+        response = self.session.post(request.url, data=request.message, headers=request.headers,
+                                     timeout=self.options.timeout, proxies=self._proxies())
+        if response.status_code in (202, 204):
+            return None
+        if response.status_code >= 400:
+            # suds parses SOAP faults from the body of the error
+            raise suds.transport.TransportError(response.reason, response.status_code,
+                                                StringIO(response.content))
+        return suds.transport.Reply(response.status_code, response.headers, response.content)
+
+# suds creates one class per type name, so whether a value is of an
+# Array type only needs to be worked out once per class
+_array_classes = {}
+
+def _property_value(val):
+    """ Return the value of a property, unwrapping suds Array types """
+    cls = val.__class__
+    is_array = _array_classes.get(cls)
+    if is_array is None:
+        is_array = _array_classes[cls] = cls.__name__.startswith('Array')
+    if is_array:
+        # suds embeds Array-type data into lists
+        return val[0]
+    return val
+
+class _ShallowBuilder(suds.builder.Builder):
+    """
+    suds object builder that only materializes child objects down to a
+    given depth and leaves the fields below it as None. The default
+    builder materializes the complete nested type graph on every
+    factory.create() call which can take seconds for the larger vSphere
+    types.
+    """
+    def __init__(self, resolver, max_depth):
+        """
+        @param max_depth: number of object levels below the built object
+                          to materialize, the fields of the built object
+                          itself are on level 1
+        """
+        suds.builder.Builder.__init__(self, resolver)
+        self.max_depth = max_depth
+
+    def process(self, data, type, history):
+        # The history holds one entry per object level above this field
+        if len(history) >= self.max_depth:
+            if not type.enum():
+                setattr(data, type.name, None)
+            return
+        suds.builder.Builder.process(self, data, type, history)
+
 class Vim(object):
     """
     Interface class for VMware VIM API over SOAP
     """
-    def __init__(self, url, debug=False, version=None):
+    def __init__(self, url, debug=False, version=None, cache_dir=DEFAULT_CACHE_DIR,
+                 builder_depth=DEFAULT_BUILDER_DEPTH):
         """
         @param url: URL to the vSphere server (eg.: https://foosphere/sdk)
         @param debug: Run in debug mode (very noisy)
+        @param cache_dir: directory for the parsed WSDL cache, must be writable
+                          (falls back to the suds default location if it is not).
+                          None disables the cache.
+        @param builder_depth: number of levels of child objects that
+                              create_object() materializes, deeper fields
+                              are left as None. None builds complete objects.
         """
         self.task_timeout = 600
+        self.task_poll_interval = 0.05
+        self.task_poll_interval_max = 2.0
+        self.invoke_retries = 3
         if debug:
             logging.basicConfig(level=logging.INFO)
             logging.getLogger('suds.client').setLevel(logging.DEBUG)
@@ -51,31 +287,129 @@ class Vim(object):
             logging.basicConfig(level=logging.INFO)
             logging.getLogger('suds').setLevel(logging.INFO)
 
+        # The SOAP client and the service content are set up lazily on
+        # first use, see _connect()
+        self._url = url
+        self._version = version
+        self._cache_dir = cache_dir
+        self._builder_depth = builder_depth
+        self._soapclient = None
+        self._service_content = None
+        self._full_traversal_specs = None
+        self._inventory_filter_specs = {}
+        self._container_views = {}
+        self._thread_local = threading.local()
+        self._schema_types = {}
+        self.service_instance = ManagedObjectReference(_type='ServiceInstance',
+                                                       value='ServiceInstance')
+
+    def _connect(self):
+        """
+        Load the WSDL from the server and set up the SOAP client
+        """
+        transport = KeepAliveTransport() if requests else None
+        # Cache the parsed WSDL on disk so that new clients skip the
+        # very slow schema parsing step. The cache is kept per API version
+        # so that a server upgrade does not leave the client with the old
+        # schema, and only briefly when the version is not known. The
+        # version is remembered for a while too, to save a request.
+        cache = None
+        if self._cache_dir:
+            cache_dir = _cache_location(self._cache_dir)
+            location = None
+            if cache_dir:
+                api_version = _cached_api_version(cache_dir, self._url)
+                if not api_version:
+                    api_version = _server_api_version(self._url, getattr(transport, 'session', None))
+                    if api_version:
+                        _save_api_version(cache_dir, self._url, api_version)
+                if api_version:
+                    location = _cache_location(os.path.join(cache_dir, api_version))
+            if location:
+                cache = suds.cache.ObjectCache(location=location, days=30)
+            else:
+                cache = suds.cache.ObjectCache(location=cache_dir, days=1)
         try:
-            self.soapclient = suds.client.Client(url+"/vimService.wsdl")
-        except Exception, e:
+            options = dict(cache=cache, cachingpolicy=1)
+            if transport:
+                options['transport'] = transport
+            soapclient = suds.client.Client(self._url+"/vimService.wsdl", **options)
+        except Exception as e:
             if 'imported schema (urn:reflect)' in str(e):
                 assert False, 'WSDL file set incomplete on the vSphere server. See http://kb.vmware.com/kb/2010507'
             else:
                 raise
 
-        self.soapclient.set_options(location=url)
-        self.soapclient.set_options(cachingpolicy=1)
-        self.service_instance = ManagedObjectReference(_type='ServiceInstance',
-                                                       value='ServiceInstance')
-        self.service_content = self.invoke('RetrieveServiceContent',
-                                           _this=self.service_instance)
-        self.property_collector = self.service_content.propertyCollector
-        self.full_traversal_specs = self._build_full_traversal_specs()
+        soapclient.set_options(location=self._url)
+        if self._builder_depth:
+            soapclient.factory.builder = _ShallowBuilder(soapclient.factory.resolver,
+                                                         self._builder_depth)
+        self._soapclient = soapclient
+
+    @property
+    def soapclient(self):
+        if self._soapclient is None:
+            self._connect()
+        return self._soapclient
+
+    @property
+    def service_content(self):
+        if self._service_content is None:
+            self._service_content = self.invoke('RetrieveServiceContent',
+                                                _this=self.service_instance)
+        return self._service_content
+
+    @property
+    def property_collector(self):
+        return self.service_content.propertyCollector
+
+    @property
+    def full_traversal_specs(self):
+        if self._full_traversal_specs is None:
+            specs = _traversal_specs_cache.get(self._url)
+            if specs is None:
+                specs = _traversal_specs_cache[self._url] = self._build_full_traversal_specs()
+            self._full_traversal_specs = specs
+        return self._full_traversal_specs
 
     def create_object(self, object_type):
-        return self.soapclient.factory.create("ns0:%s" % object_type)
+        # Resolving the type from the schema costs more than building the
+        # object, so only do it once per type
+        schema_type = self._schema_types.get(object_type)
+        if schema_type is None:
+            factory = self.soapclient.factory
+            schema_type = factory.resolver.find("ns0:%s" % object_type)
+            if schema_type is None or schema_type.enum():
+                return factory.create("ns0:%s" % object_type)
+            self._schema_types[object_type] = schema_type
+        return self.soapclient.factory.builder.build(schema_type)
 
     def invoke(self, method, **kwargs):
-        try:
-            return getattr(self.soapclient.service, method)(**kwargs)
-        except httplib.BadStatusLine:
-            return None
+        # Only calls that do not change anything on the server are safe to
+        # repeat when the connection breaks before the reply is read
+        attempts = self.invoke_retries if method.startswith(_IDEMPOTENT_PREFIXES) else 1
+        for attempt in xrange(attempts):
+            try:
+                return getattr(self.soapclient.service, method)(**kwargs)
+            except _CONNECTION_ERRORS as e:
+                if attempt == attempts - 1:
+                    # Callers have always got None for a dropped reply,
+                    # any other connection error is theirs to handle
+                    if isinstance(e, httplib.BadStatusLine):
+                        return None
+                    raise
+                time.sleep(0.1 * 2**attempt + random.random() * 0.1)
+
+    def _launch_task(self, method, **kwargs):
+        """
+        Start a task on the server without waiting for it
+
+        @param method: name of the *_Task method to invoke
+        @param **kwargs: keyword arguments to be passed to the method
+
+        @returns: task object
+        """
+        return ManagedObject(mor=self.invoke(method, **kwargs), vim=self)
 
     def invoke_task(self, method, **kwargs):
         """
@@ -86,50 +420,152 @@ class Vim(object):
 
         @returns: True on success
         """
-        task_mor = self.invoke(method=method, **kwargs)
-        task = ManagedObject(mor=task_mor, vim=self)
+        return self.wait_for_task(self._launch_task(method, **kwargs))
+
+    def wait_for_task(self, task):
+        """
+        Keep polling until a task completes or times out
+
+        @param task: task object to wait for, its 'info' is kept up to date
+
+        @returns: True on success
+        """
+        # One poll is enough for tasks that are already done, the server
+        # side wait only pays off for the ones still running
+        task.update_local_view(properties=['info'])
+        if task.info.state == 'success':
+            return True
+        elif task.info.state == 'error':
+            raise TaskFailedError(task.info.error.localizedMessage)
+        try:
+            return self._wait_for_task_event(task)
+        except (suds.MethodNotFound, suds.TypeNotFound):
+            # No WaitForUpdatesEx before vSphere 4.1, fall back to polling
+            return self._poll_task(task)
+
+    def _poll_task(self, task):
+        """
+        Poll the state of a task until it completes or times out
+
+        @param task: task object to wait for
+
+        @returns: True on success
+        """
         start_time = time.time()
+        interval = self.task_poll_interval
+        last_state = None
         while True:
             task.update_local_view(properties=['info'])
             if task.info.state == 'success':
                 return True
             elif task.info.state == 'error':
-                raise TaskFailedError(error=task.info.error.localizedMessage)
-            time.sleep(1)
+                raise TaskFailedError(task.info.error.localizedMessage)
+            # Poll quickly right after a state change, then back off
+            if task.info.state != last_state:
+                last_state = task.info.state
+                interval = self.task_poll_interval
+            time.sleep(interval)
+            interval = min(interval * 1.5, self.task_poll_interval_max)
             if time.time()-start_time > self.task_timeout:
-                raise TimeoutError, "task timed out after %d seconds" % self.task_timeout
+                raise TimeoutError("task timed out after %d seconds" % self.task_timeout)
 
-    def wait_for_task(self, task):
+    def _wait_for_task_event(self, task):
         """
-        Keep pollint until a task completes or times out
+        Wait until a task completes or times out without polling
+
+        A property filter is registered for the info of the task on a
+        property collector of its own, and WaitForUpdatesEx blocks on the
+        server until the info changes. The changes are applied to the task.
 
         @param task: task object to wait for
 
         @returns: True on success
+
+        @note: raises suds.TypeNotFound or suds.MethodNotFound before
+               anything is set up on servers older than vSphere 4.1
         """
+        options = self.create_object('WaitOptions')
+        pfs = self._object_filter_spec([task.mor], ['info'])
+        # A private collector does not mix with the updates of other
+        # waiters on the same session
+        collector = self.invoke('CreatePropertyCollector', _this=self.property_collector)
+        try:
+            self.invoke('CreateFilter', _this=collector, spec=pfs, partialUpdates=False)
+            start_time = time.time()
+            version = ''
+            while task.info.state not in ('success', 'error'):
+                remaining = self.task_timeout - (time.time()-start_time)
+                if remaining <= 0:
+                    raise TimeoutError("task timed out after %d seconds" % self.task_timeout)
+                options.maxWaitSeconds = max(1, min(int(remaining), MAX_WAIT_SECONDS))
+                update_set = self.invoke('WaitForUpdatesEx', _this=collector,
+                                         version=version, options=options)
+                if not update_set:
+                    continue
+                version = update_set.version
+                for filter_update in getattr(update_set, 'filterSet', []):
+                    for object_update in filter_update.objectSet:
+                        for change in getattr(object_update, 'changeSet', []):
+                            if change.name == 'info' and hasattr(change, 'val'):
+                                task.info = _property_value(change.val)
+                                task._fetched['info'] = time.time()
+            if task.info.state == 'error':
+                raise TaskFailedError(task.info.error.localizedMessage)
+            return True
+        finally:
+            # Destroys the filter too
+            self.invoke('DestroyPropertyCollector', _this=collector)
+
+    def wait_for_tasks(self, tasks):
+        """
+        Keep polling until all of the tasks complete or time out
+
+        All the pending tasks are updated with a single RetrieveProperties
+        call per polling round.
+
+        @param tasks: list of task objects to wait for
+
+        @returns: True when all the tasks have succeeded
+        """
+        pending = dict((id(task), task) for task in tasks)
         start_time = time.time()
-        while True:
-            task.update_local_view(properties=['info'])
-            if task.info.state == 'success':
-                return True
-            elif task.info.state == 'error':
-                raise TaskFailedError(error=task.info.error.localizedMessage)
-            time.sleep(1)
+        interval = self.task_poll_interval
+        while pending:
+            _, updated_tasks = self.update_many_objects(pending, TASK_UPDATE_PROPERTIES)
+            for key, task in updated_tasks.iteritems():
+                info = getattr(task, 'info', None)
+                if not info:
+                    continue
+                if info.state == 'success':
+                    del pending[key]
+                    interval = self.task_poll_interval
+                elif info.state == 'error':
+                    raise TaskFailedError(info.error.localizedMessage)
+            if not pending:
+                break
+            time.sleep(interval)
+            interval = min(interval * 1.5, self.task_poll_interval_max)
             if time.time()-start_time > self.task_timeout:
-                raise TimeoutError, "task timed out after %d seconds" % self.task
+                raise TimeoutError("tasks timed out after %d seconds" % self.task_timeout)
+        return True
 
-    def update_many_objects(self, objects):
+    def update_many_objects(self, objects, property_types=None):
         """
-        Get an update on a list of tasks at once
+        Get an update on a number of objects at once
 
-        @param tasks: dict of task objects to update
+        @param objects: dict of key -> object to update
+        @param property_types: list of (type, properties) tuples to fetch,
+                               defaults to DEFAULT_UPDATE_PROPERTIES
 
-        @returns: dict of updated tasks (empty ones untouched)
+        @returns: tuple of (success, dict of key -> updated object), empty
+                  objects are returned untouched
 
-        @note: It handles 'Task' and 'VirtualMachine' object types
+        @note: By default it handles 'Task' and 'VirtualMachine' object types
+        @note: raises ObjectNotFoundError if some of the objects no longer
+               exist on the server, its 'keys' attribute lists their keys
          """
-        property_types = [ ('Task', ['info']),
-                           ('VirtualMachine', ['name', 'summary']) ]
+        if property_types is None:
+            property_types = DEFAULT_UPDATE_PROPERTIES
         prop_set = []
         for ptype,ppath in property_types:
             property_spec = self.create_object('PropertySpec')
@@ -149,25 +585,46 @@ class Vim(object):
             object_spec.obj = obj.mor
             object_set.append(object_spec)
             object_map[obj.mor.value] = key
+        if not object_set:
+            return True, updated_objects
         pfs = self.create_object('PropertyFilterSpec')
         pfs.propSet = prop_set
         pfs.objectSet = object_set
-        object_contents = self.invoke('RetrieveProperties',
-                                          _this=self.property_collector,
-                                          specSet=pfs)
-        if not object_contents or len(object_contents) != len(objects):
+        if hasattr(pfs, 'reportMissingObjectsInResults'):
+            # Objects deleted meanwhile (eg. finished tasks that have been
+            # purged) come back in missingSet instead of failing the whole
+            # call with a ManagedObjectNotFound fault
+            pfs.reportMissingObjectsInResults = True
+        object_contents = self._retrieve(pfs)
+        if len(object_contents) != len(object_set):
             return False, objects
+        missing = [object_map[x.obj.value] for x in object_contents
+                   if getattr(x, 'missingSet', None) and not getattr(x, 'propSet', None)]
+        if missing:
+            error = ObjectNotFoundError('objects no longer exist: %s' % ', '.join(str(x) for x in missing))
+            error.keys = missing
+            raise error
         for object_content in object_contents:
             updated_object = ManagedObject(mor=object_content.obj, vim=self)
-            for prop in object_content.propSet:
-                if prop.val.__class__.__name__.startswith('Array'):
-                    # suds embeds Array-type data into lists
-                    setattr(updated_object, prop.name, prop.val[0])
-                else:
-                    setattr(updated_object, prop.name, prop.val)
+            updated_object.update_object(object_content)
             updated_objects[object_map[object_content.obj.value]] = updated_object
         return True, updated_objects
 
+    def property_watcher(self, property_types=DEFAULT_UPDATE_PROPERTIES):
+        """
+        Get a watcher that keeps a set of objects up to date
+
+        @param property_types: list of (type, properties) tuples to watch
+
+        @return: PropertyWatcher or None if the server does not support
+                 WaitForUpdatesEx (before vSphere 4.1)
+        """
+        try:
+            getattr(self.soapclient.service, 'WaitForUpdatesEx')
+        except suds.MethodNotFound:
+            return None
+        return PropertyWatcher(self, property_types)
+
     def login(self, username, password):
         """
         Log in to the vSphere service
@@ -177,13 +634,62 @@ class Vim(object):
         """
         self.invoke('Login', _this=self.service_content.sessionManager,
                     userName=username, password=password)
+        # The container views of the inventory specs belong to the session
+        self._inventory_filter_specs = {}
+        self._container_views = {}
 
     def logout(self):
         """
         Log out from the vSphere service
         """
+        self.destroy_views()
         self.invoke('Logout', _this=self.service_content.sessionManager)
 
+    def destroy_views(self):
+        """
+        Remove the container views created for inventory lookups from the server
+
+        Views live as long as the session, so call this when done with a
+        session that is kept alive for later use. New views are created
+        on the next lookup.
+        """
+        views, self._container_views = self._container_views, {}
+        self._inventory_filter_specs = {}
+        for view in views.itervalues():
+            self.invoke('DestroyView', _this=view)
+
+    def session_cookie(self):
+        """
+        Get the session cookie of the current login, see resume_session()
+
+        @return: value of the session cookie or None if not logged in
+        """
+        transport = self.soapclient.options.transport
+        cookies = transport.session.cookies if hasattr(transport, 'session') else transport.cookiejar
+        for cookie in cookies:
+            if cookie.name == SESSION_COOKIE:
+                return cookie.value
+        return None
+
+    def resume_session(self, cookie):
+        """
+        Continue a session logged in earlier instead of logging in again
+
+        @param cookie: value of the session cookie from session_cookie()
+
+        @return: True if the session is still active, False otherwise
+        """
+        self.soapclient.set_options(headers={'Cookie': '%s=%s' % (SESSION_COOKIE, cookie)})
+        try:
+            session_manager = ManagedObject(self.service_content.sessionManager, self, ['currentSession'])
+        except suds.WebFault:
+            session_manager = None
+        if session_manager and getattr(session_manager, 'currentSession', None):
+            return True
+        # Let the cookie from a new login take over
+        self.soapclient.set_options(headers={})
+        return False
+
     def find_entities_by_type(self, entity_type, properties=None):
         """
         Find vSphere entities (ManagedObjects) by type
@@ -193,26 +699,235 @@ class Vim(object):
 
         @return: list of found objects
         """
-        # Prop spec
+        return list(self.iter_entities_by_type(entity_type, properties=properties))
+
+    def iter_entities_by_type(self, entity_type, properties=None, chunk=100):
+        """
+        Iterate over vSphere entities (ManagedObjects) of a type
+
+        The entities are retrieved from the server in pages so that only
+        one page needs to be held in memory at a time.
+
+        @param entity_type: type of the entity (for example 'DataStore')
+        @param properties: list of properties to fetch immediately
+        @param chunk: maximum number of entities to retrieve per call
+
+        @return: generator of found objects
+
+        @note: close() the generator when stopping early to free the server
+               side state right away
+        """
+        propfilterspec = self._inventory_filter_spec({entity_type: properties})
+        contents = self._iter_retrieve(propfilterspec, max_objects=chunk)
+        try:
+            for object_content in contents:
+                yield self.object_from_object_content(object_content)
+        finally:
+            contents.close()
+
+    def find_entities_by_types(self, type_properties):
+        """
+        Find vSphere entities of several types with a single inventory traversal
+
+        @param type_properties: dict of entity type -> list of properties to
+                                fetch immediately (for example
+                                {'Datastore': ['summary'], 'ResourcePool': None})
+
+        @return: dict of entity type -> list of found objects
+        """
+        objects = [self.object_from_object_content(x)
+                   for x in self._iter_retrieve(self._inventory_filter_spec(type_properties))]
+        return self._group_by_type(type_properties, objects)
+
+    def _group_by_type(self, entity_types, objects):
+        """
+        Sort objects into lists by the requested entity types
+
+        @param entity_types: the requested types, subtypes are grouped
+                             under their parent type unless requested too
+        @param objects: list of objects to sort
+
+        @return: dict of entity type -> list of objects
+        """
+        grouped = dict((x, []) for x in entity_types)
+        for obj in objects:
+            entity_type = obj.mor._type
+            if entity_type not in grouped:
+                entity_type = _PARENT_TYPES.get(entity_type)
+            if entity_type in grouped:
+                grouped[entity_type].append(obj)
+        return grouped
+
+    def _inventory_filter_spec(self, type_properties):
+        """
+        Build a filter spec that collects entities from the whole inventory
+
+        @param type_properties: dict of entity type -> list of properties
+                                to fetch in addition to 'name'
+
+        @return: PropertyFilterSpec, shared between calls so do not modify it
+        """
+        # The specs only depend on the requested types and properties, so
+        # build each combination only once
+        key = tuple(sorted((t, tuple(p or ())) for t, p in type_properties.iteritems()))
+        if key in self._inventory_filter_specs:
+            return self._inventory_filter_specs[key]
+        prop_set = []
+        for entity_type, properties in type_properties.iteritems():
+            propspec = self.create_object('PropertySpec')
+            propspec.type = entity_type
+            propspec.all = False
+            propspec.pathSet = ['name']
+            if properties:
+                propspec.pathSet.extend(properties)
+            prop_set.append(propspec)
+        objspec = self.create_object('ObjectSpec')
+        view = self._container_view(sorted(type_properties))
+        if view:
+            # The server keeps the view up to date, so collecting from it
+            # does not walk the folder hierarchy on every call
+            traversal_spec = self.create_object('TraversalSpec')
+            traversal_spec.name = 'view_to_entity'
+            traversal_spec.type = 'ContainerView'
+            traversal_spec.path = 'view'
+            traversal_spec.skip = False
+            objspec.obj = view
+            objspec.skip = True
+            objspec.selectSet = [traversal_spec]
+        else:
+            objspec.obj = self.service_content.rootFolder
+            objspec.selectSet = self.full_traversal_specs
+        propfilterspec = self.create_object('PropertyFilterSpec')
+        propfilterspec.propSet = prop_set
+        propfilterspec.objectSet = [objspec]
+        self._inventory_filter_specs[key] = propfilterspec
+        return propfilterspec
+
+    def _container_view(self, entity_types):
+        """
+        Get a view of all the entities of the given types in the inventory
+
+        One view is created per set of types and shared by all the lookups
+        of those types, whatever properties they fetch.
+
+        @param entity_types: list of entity types, subtypes are included
+
+        @return: reference to the ContainerView, None if the server does
+                 not support views (before vSphere 4.0)
+
+        @note: the view is kept until destroy_views() or logout()
+        """
+        key = tuple(sorted(entity_types))
+        view = self._container_views.get(key)
+        if view:
+            return view
+        view_manager = getattr(self.service_content, 'viewManager', None)
+        if not view_manager:
+            return None
+        view = self.invoke('CreateContainerView', _this=view_manager,
+                           container=self.service_content.rootFolder,
+                           type=list(key), recursive=True)
+        if view:
+            self._container_views[key] = view
+        return view
+
+    def _object_filter_spec(self, mors, properties):
+        """
+        Build a filter spec that collects properties of the given objects
+
+        @param mors: list of managed object references of the same type
+        @param properties: list of properties to fetch
+
+        @return: PropertyFilterSpec
+        """
         propspec = self.create_object('PropertySpec')
-        propspec.type = entity_type
+        propspec.type = mors[0]._type
         propspec.all = False
-        propspec.pathSet = ['name']
-        if properties:
-            propspec.pathSet.extend(properties)
-        # Obj spec
-        objspec = self.create_object('ObjectSpec')
-        objspec.obj = self.service_content.rootFolder
-        objspec.selectSet = self.full_traversal_specs
-        # Filter spec
+        propspec.pathSet = list(properties)
+        object_set = []
+        for mor in mors:
+            objspec = self.create_object('ObjectSpec')
+            objspec.obj = mor
+            object_set.append(objspec)
         propfilterspec = self.create_object('PropertyFilterSpec')
-        #propfilterspec.reportMissingObjectsInResults = None
         propfilterspec.propSet = [propspec]
-        propfilterspec.objectSet = [objspec]
-        result = self.invoke('RetrieveProperties',
-                             _this=self.property_collector,
-                             specSet=propfilterspec)
-        return [self.object_from_object_content(x) for x in result]
+        propfilterspec.objectSet = object_set
+        return propfilterspec
+
+    def _single_object_filter_spec(self, mor, properties):
+        """
+        Get a filter spec that collects properties of a single object
+
+        The spec is built once per object type and property list, later
+        calls only swap in the object reference.
+
+        @param mor: managed object reference
+        @param properties: list of properties to fetch
+
+        @return: PropertyFilterSpec, shared between calls so do not keep it
+
+        @note: The specs are kept per thread as they are modified in place
+        """
+        object_filter_specs = getattr(self._thread_local, 'object_filter_specs', None)
+        if object_filter_specs is None:
+            object_filter_specs = self._thread_local.object_filter_specs = {}
+        key = (mor._type, tuple(sorted(properties)))
+        propfilterspec = object_filter_specs.get(key)
+        if propfilterspec is None:
+            propfilterspec = self._object_filter_spec([mor], key[1])
+            object_filter_specs[key] = propfilterspec
+        else:
+            propfilterspec.objectSet[0].obj = mor
+        return propfilterspec
+
+    def _iter_retrieve(self, spec_set, max_objects=100):
+        """
+        Retrieve properties page by page with RetrievePropertiesEx
+
+        @param spec_set: PropertyFilterSpec or a list of them
+        @param max_objects: maximum number of objects per page
+
+        @return: generator of ObjectContents
+        """
+        try:
+            options = self.create_object('RetrieveOptions')
+            options.maxObjects = max_objects
+            result = self.invoke('RetrievePropertiesEx', _this=self.property_collector,
+                                 specSet=spec_set, options=options)
+        except (suds.MethodNotFound, suds.TypeNotFound):
+            # No RetrievePropertiesEx nor RetrieveOptions before vSphere 4.1
+            for object_content in self._retrieve(spec_set):
+                yield object_content
+            return
+        token = None
+        try:
+            while result:
+                token = getattr(result, 'token', None)
+                for object_content in result.objects:
+                    yield object_content
+                if not token:
+                    break
+                next_token, token = token, None
+                result = self.invoke('ContinueRetrievePropertiesEx', _this=self.property_collector,
+                                     token=next_token)
+        finally:
+            # Free the server side state if the caller stopped early
+            if token:
+                self.invoke('CancelRetrievePropertiesEx', _this=self.property_collector, token=token)
+
+    def _retrieve(self, spec_set):
+        """
+        Retrieve properties with one or more filter specs in a single call
+
+        @param spec_set: PropertyFilterSpec or a list of them
+
+        @return: list of ObjectContents
+        """
+        if not spec_set:
+            return []
+        return self.invoke('RetrieveProperties',
+                           _this=self.property_collector,
+                           specSet=spec_set) or []
 
     def object_from_object_content(self, object_content):
         if object_content.obj._type == 'VirtualMachine':
@@ -222,6 +937,72 @@ class Vim(object):
         obj.update_object(object_content)
         return obj
 
+    def object_from_mor(self, mor, properties=None):
+        """
+        Wrap a managed object reference into an object of the matching class
+
+        @param mor: managed object reference
+        @param properties: list of properties to fetch immediately
+
+        @return: VirtualMachine or ManagedObject
+        """
+        if mor._type == 'VirtualMachine':
+            return VirtualMachine(mor, self, properties)
+        return ManagedObject(mor, self, properties)
+
+    def retrieve_multi(self, mor_properties):
+        """
+        Fetch properties of several objects in a single call
+
+        @param mor_properties: list of (managed object reference, list of
+                               properties) tuples
+
+        @return: dict of reference value -> object, objects missing on the
+                 server are left out
+        """
+        grouped = {}
+        for mor, properties in mor_properties:
+            key = (mor._type, tuple(properties))
+            grouped.setdefault(key, []).append(mor)
+        spec_set = [self._object_filter_spec(mors, properties)
+                    for (_, properties), mors in grouped.iteritems()]
+        return dict((x.obj.value, self.object_from_object_content(x))
+                    for x in self._retrieve(spec_set))
+
+    def find_by_name(self, entity_type, entity_name, properties=None):
+        """
+        Find a specific vSphere entity by name without fetching the whole inventory
+
+        Inventory paths (eg. 'Datacenter/vm/Folder/vmname') and folders are
+        resolved with the SearchIndex directly and virtual machines are first
+        looked up by their DNS name. If that does not give a match the whole
+        inventory is scanned with find_entity_by_name(), except for folders
+        which are only looked up by their inventory path.
+
+        @param entity_type: type of the entity (for example 'Datastore')
+        @param entity_name: name or inventory path of the entity
+        @param properties: list of properties to fetch immediately
+
+        @return: object or None if not found
+        """
+        search_index = self.service_content.searchIndex
+        mor = None
+        # Folders have always been given as inventory paths, so a plain
+        # name is taken as a path first too
+        by_path = '/' in entity_name or entity_type == 'Folder'
+        if by_path:
+            mor = self.invoke('FindByInventoryPath', _this=search_index, inventoryPath=entity_name)
+        elif entity_type == 'VirtualMachine':
+            mor = self.invoke('FindByDnsName', _this=search_index, dnsName=entity_name, vmSearch=True)
+        if mor and entity_type in (mor._type, _PARENT_TYPES.get(mor._type)):
+            obj = self.object_from_mor(mor, ['name'] + list(properties or []))
+            # The DNS name of a VM does not necessarily match its name
+            if by_path or obj.name == entity_name:
+                return obj
+        if entity_type == 'Folder':
+            return None
+        return self.find_entity_by_name(entity_type, entity_name, properties=properties)
+
     def find_entity_by_name(self, entity_type, entity_name, properties=None):
         """
         Find a specific vSphere entity (ManagedObjects) by its name
@@ -232,92 +1013,91 @@ class Vim(object):
 
         @return: object or None if not found
         """
-        entities = self.find_entities_by_type(entity_type, properties=properties)
-        for e in entities:
-            if e.name == entity_name:
-                return e
+        # Stop paging through the inventory as soon as there is a match
+        entities = self.iter_entities_by_type(entity_type, properties=properties)
+        try:
+            for e in entities:
+                if e.name == entity_name:
+                    return e
+        finally:
+            entities.close()
         return None
 
     def find_vm_by_name(self, vmname, properties=None):
         """
         Find a virtual machine by its name
 
-        @param vmname: name of VM
+        @param vmname: name or inventory path of the VM
 
         @return: VirtualMachine object or None if not found
         """
-        return self.find_entity_by_name('VirtualMachine', vmname, properties=properties)
+        return self.find_by_name('VirtualMachine', vmname, properties=properties)
+
+    def find_vms_by_names(self, vmnames, properties=None):
+        """
+        Find a number of virtual machines by their names with one inventory scan
+
+        @param vmnames: list of VM names
+        @param properties: list of properties to fetch immediately
+
+        @return: dict of VM name -> VirtualMachine object, VMs not found
+                 are left out
+        """
+        wanted = set(vmnames)
+        found = {}
+        if not wanted:
+            return found
+        vms = self.iter_entities_by_type('VirtualMachine', properties=properties)
+        try:
+            for vm in vms:
+                if vm.name in wanted and vm.name not in found:
+                    found[vm.name] = vm
+                    if len(found) == len(wanted):
+                        break
+        finally:
+            vms.close()
+        return found
+
+    def find_vm_fast(self, name_or_uuid, properties=None):
+        """
+        Find a virtual machine by its BIOS UUID, inventory path or name
+
+        UUIDs are looked up with the SearchIndex, everything else goes
+        through find_vm_by_name().
+
+        @param name_or_uuid: BIOS UUID, name or inventory path of the VM
+        @param properties: list of properties to fetch immediately
+
+        @return: VirtualMachine object or None if not found
+        """
+        if _UUID_RE.match(name_or_uuid):
+            mor = self.invoke('FindByUuid', _this=self.service_content.searchIndex,
+                              uuid=name_or_uuid, vmSearch=True)
+            if mor:
+                return self.object_from_mor(mor, ['name'] + list(properties or []))
+        return self.find_vm_by_name(name_or_uuid, properties=properties)
 
     def _build_full_traversal_specs(self):
+        # A SelectionSpec is only a name reference, so one object per
+        # name can be shared by all the traversal specs
+        selection_specs = {}
         def selection_spec(specname):
-            selspec = self.create_object('SelectionSpec')
-            selspec.name = specname
-            return selspec
-        # Description of the traversal specs needed to walk the
-        # whole inventory. Yes, this is magic.
-        traversals = [
-            dict(name = 'rp_to_rp',
-                 type = 'ResourcePool',
-                 path = 'resourcePool',
-                 selectSet = [selection_spec('rp_to_rp'),
-                              selection_spec('rp_to_vm')]),
-            dict(name = 'rp_to_vm',
-                 type = 'ResourcePool',
-                 path = 'vm'),
-            dict(name = 'cr_to_rp',
-                 type = 'ComputeResource',
-                 path = 'resourcePool',
-                 selectSet = [selection_spec('rp_to_rp'),
-                              selection_spec('rp_to_vm')]),
-            dict(name = 'cr_to_ds',
-                 type = 'ComputeResource',
-                 path = 'datastore'),
-            dict(name = 'cr_to_h',
-                 type = 'ComputeResource',
-                 path = 'host'),
-            dict(name = 'dc_to_hf',
-                 type = 'Datacenter',
-                 path = 'hostFolder',
-                 selectSet = [selection_spec('f_to_f')]),
-            dict(name = 'dc_to_vmf',
-                 type = 'Datacenter',
-                 path = 'vmFolder',
-                 selectSet = [selection_spec('f_to_f')]),
-            dict(name = 'dc_to_nf',
-                 type = 'Datacenter',
-                 path = 'networkFolder',
-                 selectSet = [selection_spec('f_to_f')]),
-            dict(name = 'dc_to_dsf',
-                 type = 'Datacenter',
-                 path = 'datastoreFolder',
-                 selectSet = [selection_spec('f_to_f')]),
-            dict(name = 'h_to_vm',
-                 type = 'HostSystem',
-                 path = 'vm',
-                 selectSet = [selection_spec('f_to_f')]),
-            dict(name = 'f_to_f',
-                 type = 'Folder',
-                 path = 'childEntity',
-                 selectSet = [selection_spec('f_to_f'),
-                              selection_spec('dc_to_hf'),
-                              selection_spec('dc_to_vmf'),
-                              selection_spec('dc_to_nf'),
-                              selection_spec('dc_to_dsf'),
-                              selection_spec('cr_to_h'),
-                              selection_spec('cr_to_ds'),
-                              selection_spec('cr_to_rp'),
-                              selection_spec('h_to_vm'),
-                              selection_spec('rp_to_vm')])
-            ]
+            if specname not in selection_specs:
+                selspec = self.create_object('SelectionSpec')
+                selspec.name = specname
+                selection_specs[specname] = selspec
+            return selection_specs[specname]
         traversal_specs = []
-        for traversal in traversals:
+        for name, type_, path, selections in _TRAVERSAL_TEMPLATE:
             traversal_spec = self.create_object('TraversalSpec')
-            for k,v in traversal.iteritems():
-                setattr(traversal_spec, k, v)
+            traversal_spec.name = name
+            traversal_spec.type = type_
+            traversal_spec.path = path
+            if selections:
+                traversal_spec.selectSet = [selection_spec(x) for x in selections]
             traversal_specs.append(traversal_spec)
         return traversal_specs
 
-
 class ManagedObjectReference(suds.sudsobject.Property):
     """ Custom class hack to augment Property with _type """
     def __init__(self, _type, value):
@@ -326,72 +1106,102 @@ class ManagedObjectReference(suds.sudsobject.Property):
 
 
 class ManagedObject(object):
+    # Slots for the references and the commonly fetched properties keep
+    # large inventories small. Other properties end up in __dict__.
+    __slots__ = ('mor', 'vim', 'name', 'info', 'summary', 'config', 'storage',
+                 'datastore', 'resourcePool', 'parent', 'snapshot', '_fetched', '__dict__')
+
     def __init__(self, mor, vim, properties=None):
         self.mor = mor
         self.vim = vim
+        self._fetched = {}
         if properties:
             self.update_local_view(properties)
 
-    def update_local_view(self, properties=None):
+    def update_local_view(self, properties=None, max_age=None):
         """
         Update the local version of the specified properties from the server
 
         @param properties: list of property names to update
+        @param max_age: skip properties fetched less than this many seconds
+                        ago, None always fetches all of them
 
         @return: True on success, False otherwise
         """
         assert properties, "properties must be specified"
-        # Specify which properties we want
+        if max_age is not None:
+            now = time.time()
+            properties = [x for x in properties
+                          if now - self._fetched.get(x, 0) >= max_age]
+            if not properties:
+                return True
         # TODO: could do an 'all' here if needed
-        property_spec = self.vim.create_object('PropertySpec')
-        property_spec.type = str(self.mor._type)
-        property_spec.all = False
-        property_spec.pathSet = properties
-        object_spec = self.vim.create_object('ObjectSpec')
-        object_spec.obj = self.mor
-        pfs = self.vim.create_object('PropertyFilterSpec')
-        pfs.propSet = [property_spec]
-        pfs.objectSet = [object_spec]
-        object_contents = self.vim.invoke('RetrieveProperties',
-                                          _this=self.vim.property_collector,
-                                          specSet=pfs)
+        pfs = self.vim._single_object_filter_spec(self.mor, properties)
+        object_contents = self.vim._retrieve(pfs)
         if len(object_contents) == 1:
             self.update_object(object_contents[0])
             return True
         else:
             return False
 
+    def ensure_properties(self, properties):
+        """
+        Fetch those of the specified properties that are not known locally yet
+
+        @param properties: list of property names needed
+
+        @return: True on success, False otherwise
+        """
+        missing = [x for x in properties if not hasattr(self, x)]
+        if missing:
+            return self.update_local_view(properties=missing)
+        return True
+
     def update_object(self, object_content):
         """
         Update the object from an object content response from the server
 
         @param object_content: object content to update with
         """
+        now = time.time()
         for prop in getattr(object_content, 'propSet', []):
-            if prop.val.__class__.__name__.startswith('Array'):
-                # suds embeds Array-type data into lists
-                setattr(self, prop.name, prop.val[0])
-            else:
-                setattr(self, prop.name, prop.val)
+            setattr(self, prop.name, _property_value(prop.val))
+            self._fetched[prop.name] = now
+
+    def _launch_task(self, method, **kwargs):
+        """
+        Start a task on this object without waiting for it
+
+        The task may change the object, so locally known properties are
+        no longer considered fresh by update_local_view().
+
+        @param method: name of the *_Task method to invoke
+        @param **kwargs: keyword arguments to be passed to the method
+
+        @returns: task object
+        """
+        self._fetched.clear()
+        return self.vim._launch_task(method, _this=self.mor, **kwargs)
 
 
 class VirtualMachine(ManagedObject):
+    __slots__ = ()
+
     def power_state(self):
-        if not getattr(self, 'summary'):
-            self.update_local_view(['summary'])
+        self.ensure_properties(['summary'])
         return self.summary.runtime.powerState
 
     def power_on(self):
         return self.vim.wait_for_task(self.power_on_task())
 
     def power_on_task(self):
-        return ManagedObject(self.vim.invoke('PowerOnVM_Task', _this=self.mor), vim=self.vim)
+        return self._launch_task('PowerOnVM_Task')
 
     def power_off(self):
         return self.vim.wait_for_task(self.power_off_task())
 
     def power_off_task(self):
-        return ManagedObject(self.vim.invoke('PowerOffVM_Task', _this=self.mor), vim=self.vim)
+        return self._launch_task('PowerOffVM_Task')
 
     def clone_vm(self, clonename=None, linked_clone=False):
         """
@@ -409,38 +1219,78 @@ class VirtualMachine(ManagedObject):
         @param linked_clone: set True for linked clones
         @param resource_pool: name or ManagedObject, defaults to inherit from the base VM
         @param datastore: name or ManagedObject, defaults to inherit from the base VM
-        @param folder: folder to place the VM
-        @param cluster: compute resource whose resource pool to place the VM
+        @param folder: inventory path or ManagedObject of the folder to place the VM
+        @param cluster: name or ManagedObject of the compute resource whose
+                        resource pool to place the VM
 
         @notes: The clone is created on the same data store and host as its parent
         """
         assert clonename, "clonename needs to be specified"
 
-        self.update_local_view(properties=['parent', 'datastore', 'resourcePool'])
+        # Fetch the properties of this VM and the entities that need to be
+        # looked up by plain name in a single round-trip. Inventory paths
+        # are resolved separately through the SearchIndex.
+        def by_plain_name(entity):
+            return entity and not isinstance(entity, ManagedObject) and '/' not in entity
+        lookups = {}
+        if by_plain_name(datastore):
+            lookups['Datastore'] = []
+        if by_plain_name(resource_pool):
+            lookups['ResourcePool'] = []
+        elif not resource_pool:
+            if by_plain_name(cluster):
+                lookups['ComputeResource'] = ['resourcePool']
+            elif not cluster:
+                lookups['ResourcePool'] = ['parent']
+        spec_set = []
+        missing = [x for x in ('parent', 'datastore', 'resourcePool') if not hasattr(self, x)]
+        if missing:
+            spec_set.append(self.vim._object_filter_spec([self.mor], missing))
+        if lookups:
+            spec_set.append(self.vim._inventory_filter_spec(lookups))
+        found = []
+        for object_content in self.vim._retrieve(spec_set):
+            if object_content.obj._type == self.mor._type and object_content.obj.value == self.mor.value:
+                self.update_object(object_content)
+            else:
+                found.append(self.vim.object_from_object_content(object_content))
+        entities = self.vim._group_by_type(lookups, found)
+
+        def find_entity(entity_type, entity, properties=None):
+            if isinstance(entity, ManagedObject):
+                return entity
+            if by_plain_name(entity):
+                return next((x for x in entities[entity_type] if x.name == entity), None)
+            return self.vim.find_by_name(entity_type, entity, properties)
+
         if datastore:
-            clone_datastore = datastore if isinstance(datastore, ManagedObject) else self.vim.find_entity_by_name('Datastore', datastore)
+            clone_datastore = find_entity('Datastore', datastore)
         else:
             clone_datastore = ManagedObject(mor=self.datastore[0], vim=self)
         assert clone_datastore, "Datastore not set for the clone. The name %s may be incorrect" % str(datastore)
         if resource_pool:
-            clone_resource_pool = resource_pool if isinstance(resource_pool, ManagedObject) else self.vim.find_entity_by_name('ResourcePool', resource_pool)
+            clone_resource_pool = find_entity('ResourcePool', resource_pool)
             assert clone_resource_pool, "resource pool %r not found" % resource_pool
             clone_resource_pool = clone_resource_pool.mor
         else:
             if cluster:
-                compute_resource = self.vim.find_entity_by_name('ComputeResource', cluster, ['name', 'resourcePool'])
-                if not compute_resource:
+                compute_resource = find_entity('ComputeResource', cluster, ['resourcePool'])
+                if compute_resource:
+                    compute_resource.ensure_properties(['resourcePool'])
+                else:
                     raise InvalidParameterError("cluster %r not found" % cluster)
                 clone_resource_pool = compute_resource.resourcePool
             else:
                 # If neither the resource pool nor the cluster has been specified try to autodetect
                 # by finding a single root resource pool. If none or more than one found, bail.
-                resource_pools = [x for x in self.vim.find_entities_by_type('ResourcePool', ['parent'])
+                resource_pools = [x for x in entities['ResourcePool']
                                   if 'ComputeResource' in x.parent._type]
                 if len(resource_pools) != 1:
                     raise InvalidParameterError("root resource pool could not be determined unambiguously, specify the 'cluster' parameter")
                 clone_resource_pool = resource_pools[0].mor
-        if folder:
+        if isinstance(folder, ManagedObject):
+            target_folder = folder.mor
+        elif folder:
             target_folder = self.vim.invoke('FindByInventoryPath', _this=self.vim.service_content.searchIndex, inventoryPath=folder)
             if not target_folder:
                 raise InvalidParameterError("specified target folder %r not found" % folder)
@@ -460,50 +1310,45 @@ class VirtualMachine(ManagedObject):
         clonespec.powerOn = "0"
         clonespec.template = "0"
         clonespec.snapshot = None
-        task_mor = self.vim.invoke('CloneVM_Task', _this=self.mor, name=clonename, spec=clonespec, folder=target_folder)
-        task = ManagedObject(mor=task_mor, vim=self.vim)
-        return task
+        return self.vim._launch_task('CloneVM_Task', _this=self.mor, name=clonename, spec=clonespec, folder=target_folder)
 
     def delete_vm(self):
         return self.vim.wait_for_task(self.delete_vm_task())
 
     def delete_vm_task(self):
-        return ManagedObject(self.vim.invoke('Destroy_Task', _this=self.mor), vim=self.vim)
+        return self._launch_task('Destroy_Task')
 
     def create_snapshot(self, name, description=None, memory=False, quiesce=False):
         return self.vim.wait_for_task(self.create_snapshot_task(name=name, description=description,
                                                                 memory=memory, quiesce=quiesce))
 
     def create_snapshot_task(self, name, description=None, memory=False, quiesce=False):
-        return ManagedObject(self.vim.invoke('CreateSnapshot_Task', _this=self.mor, name=name,
-                                             description=description, memory=memory, quiesce=quiesce), vim=self.vim)
+        return self._launch_task('CreateSnapshot_Task', name=name,
+                                 description=description, memory=memory, quiesce=quiesce)
 
     def revert_to_current_snapshot(self):
         return self.vim.wait_for_task(self.revert_to_current_snapshot_task())
 
     def revert_to_current_snapshot_task(self):
-        return ManagedObject(self.vim.invoke('RevertToCurrentSnapshot_Task', _this=self.mor), vim=self.vim)
+        return self._launch_task('RevertToCurrentSnapshot_Task')
 
     def list_snapshots(self):
         """ Return all snapshots as VirtualMachineSnapshotTree objects """
-        def collect_snapshots(snapshot_list):
-            snapshots = []
-            for snap in snapshot_list:
-                snapshots.append(snap)
-                child_list = getattr(snap, 'childSnapshotList', None)
-                if child_list:
-                    snapshots.extend(collect_snapshots(child_list))
-            return snapshots
-
         self.update_local_view(properties=['snapshot'])
-        if getattr(self, 'snapshot', None):
-            snapshots = collect_snapshots(self.snapshot.rootSnapshotList)
-            # Swap out the snapshot references to directly-usable snapshot objects
-            for snapshot in snapshots:
-                snapshot.snapshot = VirtualMachineSnapshot(mor=snapshot.snapshot, vim=self.vim)
-            return snapshots
-        else:
+        if not getattr(self, 'snapshot', None):
             return []
+        # Walk the snapshot tree depth first, parents before their children
+        snapshots = []
+        stack = list(reversed(self.snapshot.rootSnapshotList))
+        while stack:
+            snapshot = stack.pop()
+            # Swap out the snapshot reference to a directly-usable snapshot object
+            snapshot.snapshot = VirtualMachineSnapshot(mor=snapshot.snapshot, vim=self.vim)
+            snapshots.append(snapshot)
+            child_list = getattr(snapshot, 'childSnapshotList', None)
+            if child_list:
+                stack.extend(reversed(child_list))
+        return snapshots
 
     def find_snapshots_by_name(self, name):
         return [snapshot for snapshot in self.list_snapshots() if snapshot.name == name]
@@ -533,12 +1378,21 @@ class VirtualMachine(ManagedObject):
         attr.symlinkTarget = None
         upload_url = self.vim.invoke('InitiateFileTransferToGuest', _this=guest_manager.fileManager, vm=self.mor, auth=auth, guestFilePath=temp_path, fileAttributes=attr, fileSize=len(script), overwrite=True)
         assert not '*' in upload_url, "'http://*/guestFile?id=1&token=1234'-style upload URLs are not supported yet: %r" % upload_url
-        # This hack makes urllib2 to issue a PUT request that vSphere wants for file uploads
-        opener = urllib2.build_opener(urllib2.HTTPHandler)
-        request = urllib2.Request(upload_url, data=script)
-        request.add_header('Content-Type', 'text/plain')
-        request.get_method = lambda: 'PUT'
-        url = opener.open(request)
+        if requests:
+            # Stream the script from a file object over the keep-alive
+            # session of the SOAP transport when there is one
+            session = getattr(self.vim.soapclient.options.transport, 'session', None) or requests
+            response = session.put(upload_url, data=StringIO(script),
+                                   headers={'Content-Type': 'text/plain',
+                                            'Content-Length': str(len(script))})
+            response.raise_for_status()
+        else:
+            # This hack makes urllib2 to issue a PUT request that vSphere wants for file uploads
+            opener = urllib2.build_opener(urllib2.HTTPHandler)
+            request = urllib2.Request(upload_url, data=script)
+            request.add_header('Content-Type', 'text/plain')
+            request.get_method = lambda: 'PUT'
+            url = opener.open(request)
         program_spec = self.vim.create_object('GuestProgramSpec')
         program_spec.arguments = temp_path
         program_spec.envVariables = None
@@ -562,7 +1416,7 @@ class VirtualMachine(ManagedObject):
 
         @param spec: VirtualMachineConfigSpec type
         """
-        return ManagedObject(self.vim.invoke('ReconfigVM_Task', _this=self.mor, spec=spec), vim=self.vim)
+        return self._launch_task('ReconfigVM_Task', spec=spec)
 
     def spec_new_disk(self, size, thin=True, disk_mode='persistent'):
         """
@@ -577,19 +1431,29 @@ class VirtualMachine(ManagedObject):
         disk_modes = [ "persistent", "independent_persistent", "independent_nonpersistent", "nonpersistent", "undoable", "append" ]
         assert disk_mode in disk_modes, "disk mode must be one of '%s', not %s" % (", ".join(disk_modes), disk_mode)
 
-        if not hasattr(self, 'config'):
-            assert self.update_local_view(properties=['config']), "failed to update the 'config'property of the VM"
-        # Find the virtual disk controller and its key
-        disk_controllers = [x for x in self.config.hardware.device if x.__class__.__name__ == 'VirtualLsiLogicController']
-        assert disk_controllers, "could not find virtual disk controller 'VirtualLsiLogicController'"
-        controller_key = disk_controllers[0].key
+        assert self.ensure_properties(['config']), "failed to update the 'config'property of the VM"
+        # Find the virtual disk controller, the first disk and the highest
+        # unit number in use per controller in one pass over the devices
+        controller_key = None
+        first_disk = None
+        max_unit_numbers = {}
+        for device in self.config.hardware.device:
+            device_class = device.__class__.__name__
+            if device_class == 'VirtualLsiLogicController':
+                if controller_key is None:
+                    controller_key = device.key
+            elif device_class == 'VirtualDisk':
+                if first_disk is None:
+                    first_disk = device
+                if device.unitNumber > max_unit_numbers.get(device.controllerKey, -1):
+                    max_unit_numbers[device.controllerKey] = device.unitNumber
+        assert controller_key is not None, "could not find virtual disk controller 'VirtualLsiLogicController'"
+        assert first_disk, "this method requires at least one disk to be already attached to the VM"
         # Find a unit number for the new disk
-        virtual_disks = [x for x in self.config.hardware.device if x.__class__.__name__ == 'VirtualDisk']
-        assert virtual_disks, "this method requires at least one disk to be already attached to the VM"
-        new_disk_unit_number = max([x.unitNumber for x in virtual_disks if x.controllerKey == controller_key]) + 1
+        new_disk_unit_number = max_unit_numbers.get(controller_key, -1) + 1
 
         backing = self.vim.create_object('VirtualDiskFlatVer2BackingInfo')
-        backing.datastore = virtual_disks[0].backing.datastore
+        backing.datastore = first_disk.backing.datastore
         backing.fileName = "" # File name chosen by vSphere
         backing.eagerlyScrub = False
         backing.thinProvisioned = thin
@@ -600,12 +1464,12 @@ class VirtualMachine(ManagedObject):
         disk.unitNumber = new_disk_unit_number
         disk.capacityInKB = size * 1024
         disk.backing = backing
-        file_op_enum = self.vim.create_object('VirtualDeviceConfigSpecFileOperation')
-        spec_enum = self.vim.create_object('VirtualDeviceConfigSpecOperation')
         device_config_spec = self.vim.create_object('VirtualDeviceConfigSpec')
         device_config_spec.device = disk
-        device_config_spec.fileOperation = file_op_enum.create
-        device_config_spec.operation = spec_enum.add
+        # Serialized values of the VirtualDeviceConfigSpecFileOperation and
+        # VirtualDeviceConfigSpecOperation enums
+        device_config_spec.fileOperation = 'create'
+        device_config_spec.operation = 'add'
         return device_config_spec
 
     def spec_new_nic(self, network, nic_type="vmxnet2"):
@@ -624,15 +1488,16 @@ class VirtualMachine(ManagedObject):
         nic = self.vim.create_object(NIC_TYPES[nic_type])
         nic.backing = backing
         nic.key = None
-        spec_enum = self.vim.create_object('VirtualDeviceConfigSpecOperation')
         device_config_spec = self.vim.create_object('VirtualDeviceConfigSpec')
         device_config_spec.device = nic
-        device_config_spec.operation = spec_enum.add
+        device_config_spec.operation = 'add' # VirtualDeviceConfigSpecOperation
         device_config_spec.fileOperation = None
         return device_config_spec
 
 
 class VirtualMachineSnapshot(ManagedObject):
+    __slots__ = ()
+
     def rename_snapshot(self, name=None, description=None):
         assert name or description, "at least one of 'name' and 'description' must be supplied"
         self.vim.invoke('RenameSnapshot', _this=self.mor, name=name, description=description)
@@ -641,13 +1506,105 @@ class VirtualMachineSnapshot(ManagedObject):
         return self.vim.wait_for_task(self.remove_snapshot_task(remove_children=remove_children))
 
     def remove_snapshot_task(self, remove_children=False):
-        return ManagedObject(self.vim.invoke('RemoveSnapshot_Task', _this=self.mor, removeChildren=remove_children), vim=self.vim)
+        return self._launch_task('RemoveSnapshot_Task', removeChildren=remove_children)
 
     def revert_to_snapshot(self, suppress_power_on=False):
         return self.vim.wait_for_task(self.revert_to_snapshot_task(suppress_power_on=suppress_power_on))
 
     def revert_to_snapshot_task(self, suppress_power_on=False):
-        return ManagedObject(self.vim.invoke('RevertToSnapshot_Task', _this=self.mor, suppressPowerOn=suppress_power_on), vim=self.vim)
+        return self._launch_task('RevertToSnapshot_Task', suppressPowerOn=suppress_power_on)
 
     def __eq__(self, other):
         return self.mor._type == other.mor._type and self.mor.value == other.mor.value
+
+
+class PropertyWatcher(object):
+    """
+    Keep the properties of a changing set of objects up to date
+
+    The server pushes the changes through WaitForUpdatesEx on a property
+    collector of the watcher's own, so nothing needs to be polled. The
+    changes are applied to the watched objects in place.
+    """
+    def __init__(self, vim, property_types=DEFAULT_UPDATE_PROPERTIES):
+        """
+        @param vim: Vim instance to use
+        @param property_types: list of (type, properties) tuples to watch
+        """
+        self.vim = vim
+        self.property_types = dict(property_types)
+        self.collector = None
+        self.version = ''
+        self._filters = {} # id of object -> (filter, object)
+        self._objects = {} # value of filter -> object
+
+    def watch(self, objects):
+        """
+        Set the objects to watch, replacing the previous set
+
+        @param objects: list of objects, those of types that are not
+                        watched are ignored
+        """
+        wanted = dict((id(x), x) for x in objects if x and x.mor._type in self.property_types)
+        for key in [x for x in self._filters if x not in wanted]:
+            property_filter, _ = self._filters.pop(key)
+            del self._objects[property_filter.value]
+            self.vim.invoke('DestroyPropertyFilter', _this=property_filter)
+        for key, obj in wanted.iteritems():
+            if key in self._filters:
+                continue
+            if self.collector is None:
+                self.collector = self.vim.invoke('CreatePropertyCollector',
+                                                 _this=self.vim.property_collector)
+            pfs = self.vim._object_filter_spec([obj.mor], self.property_types[obj.mor._type])
+            property_filter = self.vim.invoke('CreateFilter', _this=self.collector,
+                                              spec=pfs, partialUpdates=False)
+            self._filters[key] = (property_filter, obj)
+            self._objects[property_filter.value] = obj
+
+    def is_watched(self, obj):
+        """
+        @return: True if the object is currently watched
+        """
+        return id(obj) in self._filters
+
+    def wait(self, max_wait):
+        """
+        Wait until some of the watched objects change
+
+        @param max_wait: maximum time to wait in seconds
+
+        @return: list of changed objects, empty if nothing changed in time
+        """
+        if not self._filters:
+            return []
+        options = self.vim.create_object('WaitOptions')
+        options.maxWaitSeconds = max(1, min(int(max_wait), MAX_WAIT_SECONDS))
+        update_set = self.vim.invoke('WaitForUpdatesEx', _this=self.collector,
+                                     version=self.version, options=options)
+        if not update_set:
+            return []
+        self.version = update_set.version
+        now = time.time()
+        changed = []
+        for filter_update in getattr(update_set, 'filterSet', []):
+            obj = self._objects.get(filter_update.filter.value)
+            if obj is None:
+                continue
+            for object_update in filter_update.objectSet:
+                for change in getattr(object_update, 'changeSet', []):
+                    if hasattr(change, 'val'):
+                        setattr(obj, change.name, _property_value(change.val))
+                        obj._fetched[change.name] = now
+            changed.append(obj)
+        return changed
+
+    def close(self):
+        """
+        Remove the property collector and all the filters on the server
+        """
+        if self.collector is not None:
+            self.vim.invoke('DestroyPropertyCollector', _this=self.collector)
+        self.collector = None
+        self._filters.clear()
+        self._objects.clear()
@@ -15,13 +15,75 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
-import copy
+import collections
+import contextlib
+import cProfile
 import logging
+import os
 import random
 import time
 import traceback
 
-from vim25 import ManagedObject, InvalidParameterError, TimeoutError, TaskFailedError
+from vim25 import InvalidParameterError, ObjectNotFoundError, TimeoutError, TaskFailedError
+
+def _task_done(task):
+    return hasattr(task, 'info') and task.info.state in ('success', 'error')
+
+def _got_ip(vm):
+    return hasattr(vm, 'summary') and getattr(vm.summary.guest, 'ipAddress', None)
+
+def _guest_tools_running(vm):
+    return (hasattr(vm, 'summary') and
+            getattr(vm.summary.guest, 'toolsRunningStatus', None) == 'guestToolsRunning')
+
+# Maximum number of base VMs and clusters to keep cached
+CACHE_SIZE = 64
+
+class _LruCache(collections.OrderedDict):
+    """ Dict that drops the least recently used entries beyond its size """
+    def __init__(self, size):
+        collections.OrderedDict.__init__(self)
+        self.size = size
+
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+        # Move the entry to the most recently used end
+        value = self.pop(key)
+        collections.OrderedDict.__setitem__(self, key, value)
+        return value
+
+    def add(self, key, value):
+        self.pop(key, None)
+        collections.OrderedDict.__setitem__(self, key, value)
+        while len(self) > self.size:
+            self.popitem(last=False)
+
+def _numbered_values(mapping, prefix):
+    """ Return the non-empty values of keys <prefix>0, <prefix>1, ... in numeric order """
+    numbered = []
+    for key, value in mapping.iteritems():
+        if value and key.startswith(prefix) and key[len(prefix):].isdigit():
+            numbered.append((int(key[len(prefix):]), value))
+    return [value for _, value in sorted(numbered)]
+
+@contextlib.contextmanager
+def _maybe_profile():
+    """
+    Profile the enclosed code if PYVSPHERE_PROFILE names a file to write
+    the statistics to (load it with the pstats module)
+    """
+    path = os.environ.get('PYVSPHERE_PROFILE')
+    if not path:
+        yield
+        return
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(path)
 
 class VmOperations(object):
     """
@@ -32,8 +94,63 @@ class VmOperations(object):
         self.log = logging.getLogger('pyvsphere.vmops')
         self.log.setLevel(logging.DEBUG)
         self.vim = vim
-        self._base_vm_cache = {}
-        self._cluster_datastore_cache = {}
+        self._base_vm_cache = _LruCache(CACHE_SIZE)
+        self._cluster_datastore_cache = _LruCache(CACHE_SIZE)
+        self._entity_cache = _LruCache(CACHE_SIZE)
+        self._datastore_cache = {}
+        self._all_datastores_cached = False
+        self._reservations = {} # datastore reference value -> bytes reserved for clones
+
+    def invalidate_datastores(self):
+        """
+        Forget the cached datastores, for example after the storage
+        configuration has changed
+
+        @note: also forgets the cached base VMs as they refer to the datastores
+        """
+        self._base_vm_cache = _LruCache(CACHE_SIZE)
+        self._cluster_datastore_cache = _LruCache(CACHE_SIZE)
+        self._datastore_cache = {}
+        self._all_datastores_cached = False
+        self._reservations = {}
+
+    def invalidate_base_vm(self, base_vm_name):
+        """
+        Forget a cached base VM, for example after it has been modified
+
+        @param base_vm_name: name of the base VM as used in the instances
+        """
+        self._base_vm_cache.pop(base_vm_name, None)
+
+    def _all_datastores(self):
+        """ Find and return all the datastores as a dict of reference value -> datastore """
+        if not self._all_datastores_cached:
+            for datastore in self.vim.iter_entities_by_type('Datastore', ['summary', 'info']):
+                self._datastore_cache.setdefault(datastore.mor.value, datastore)
+            self._all_datastores_cached = True
+        return self._datastore_cache
+
+    def _get_entity(self, entity_type, name, properties=None):
+        """
+        Find an entity by name or inventory path, caching it for the next clones
+
+        @return: the entity, or the name as such if it was not found
+        """
+        if not name:
+            return name
+        entity = self._entity_cache.get((entity_type, name), None)
+        if not entity:
+            entity = self.vim.find_by_name(entity_type, name, properties)
+            if not entity:
+                # Let clone_vm_task() report it
+                return name
+            self._entity_cache.add((entity_type, name), entity)
+        return entity
+
+    def _reserve_space(self, datastore, size):
+        """ Account for space taken by a clone on a datastore, negative size releases it """
+        key = datastore.mor.value
+        self._reservations[key] = self._reservations.get(key, 0) + size
 
     def _get_base_vm(self, instance):
         """
@@ -48,29 +165,35 @@ class VmOperations(object):
         cluster = instance.get('cluster', None)
         base_vm = self._base_vm_cache.get(base_vm_name, None)
         if not base_vm:
-            base_vm = self.vim.find_vm_by_name(base_vm_name, ['storage', 'summary'])
+            base_vm = self.vim.find_vm_fast(base_vm_name, ['storage', 'summary'])
             if base_vm:
                 base_vm.size = sum([x.committed for x in base_vm.storage.perDatastoreUsage])
                 assert base_vm.size > 0, 'base vm size is zero? Very unlikely...'
                 if cluster:
                     datastores = self._datastores_in_cluster(cluster)
                 else:
-                    datastores = self.vim.find_entities_by_type('Datastore', ['name', 'summary', 'info'])
+                    datastores = self._all_datastores().itervalues()
                 # List all available datastores that contain <datastore_filter> as substring
                 base_vm.available_datastores = [x for x in datastores if datastore_filter in x.name]
                 self.log.debug('Datastores for VM %s: %s' % (base_vm_name, ','.join([x.name for x in base_vm.available_datastores])))
-                self._base_vm_cache[base_vm_name] = base_vm
+                self._base_vm_cache.add(base_vm_name, base_vm)
         return base_vm
 
     def _datastores_in_cluster(self, clustername):
         """ Find and return the list of available datastores for a ClusterComputeResource """
-        if clustername not in self._cluster_datastore_cache:
-            ccr = self.vim.find_entity_by_name('ClusterComputeResource', clustername, ['name', 'datastore'])
+        datastores = self._cluster_datastore_cache.get(clustername)
+        if datastores is None:
+            ccr = self.vim.find_by_name('ClusterComputeResource', clustername, ['datastore'])
             if not ccr:
                 raise InvalidParameterError('specified ClusterComputeResource %r not found' % clustername)
-            datastores = [ManagedObject(x, self.vim, ['name', 'summary', 'info']) for x in ccr.datastore]
-            self._cluster_datastore_cache[clustername] = datastores
-        return self._cluster_datastore_cache.get(clustername, [])
+            # Share the datastore objects with the other lookups so that the
+            # space reserved for placed clones is seen by all of them
+            known = self._datastore_cache
+            known.update(self.vim.retrieve_multi([(x, ['name', 'summary', 'info'])
+                                                  for x in ccr.datastore if x.value not in known]))
+            datastores = [known[x.value] for x in ccr.datastore if x.value in known]
+            self._cluster_datastore_cache.add(clustername, datastores)
+        return datastores
 
     def clone_vm(self, instance, nuke_old=False):
         """
@@ -82,33 +205,26 @@ class VmOperations(object):
         @param instance: dict of the VM instance to create
         @param nuke_old: should an existing VM with the same be nuked
 
+        @note: an old VM already looked up by the caller can be passed in the
+               'vm' key of the instance (None if there is none) to skip the
+               lookup done for nuke_old. The key is removed from the instance.
+
         @return: generator function
         """
-        def done(task):
-            return (hasattr(task, 'info') and
-                    (task.info.state == 'success' or
-                     task.info.state == 'error'))
-
-        def got_ip(task):
-            return (hasattr(task, 'summary') and
-                    getattr(task.summary.guest, 'ipAddress', None))
-
-        def guest_tool_running(task):
-            return (hasattr(task, 'summary') and
-                    getattr(task.summary.guest, 'toolsRunningStatus', None) == 'guestToolsRunning')
-
         def place_vm(base_vm, placement_strategy='random'):
             """ Place the VM to the available datastores either randomly or wherever there is most space """
             assert placement_strategy in ['random', 'most-space'], 'unknown placement strategy, must be either \'random\' or \'most-space\''
-            # Make a list of datastores that have enough space and sort it by free space
-            possible_targets = sorted([x for x in base_vm.available_datastores if x.summary.freeSpace > base_vm.size], key=lambda x: x.summary.freeSpace, reverse=True)
+            def free_space(datastore):
+                return datastore.summary.freeSpace - self._reservations.get(datastore.mor.value, 0)
+            # Make a list of datastores that have enough space
+            possible_targets = [x for x in base_vm.available_datastores if free_space(x) > base_vm.size]
             if len(possible_targets) == 0:
                 raise InvalidParameterError('no suitable datastore found. Are they all low on space?')
             if placement_strategy == 'random':
                 target = random.choice(possible_targets)
             if placement_strategy == 'most-space':
-                target = possible_targets[0]
-            target.summary.freeSpace -= base_vm.size
+                target = max(possible_targets, key=free_space)
+            self._reserve_space(target, base_vm.size)
             return target
 
         vm_name = instance['vm_name']
@@ -116,46 +232,71 @@ class VmOperations(object):
         if not base_vm:
             raise InvalidParameterError('base VM %s not found, check the cloud.base_vm_name property for %s' % (instance['base_vm_name'], vm_name))
 
+        looked_up = 'vm' in instance
+        clone = instance.pop('vm', None)
         if nuke_old:
-            clone = self.vim.find_vm_by_name(vm_name, ['summary'])
+            if not looked_up:
+                clone = self.vim.find_vm_by_name(vm_name, ['summary'])
+            elif clone:
+                # The caller may have looked it up long before this operation
+                # got its turn, so get the current power state
+                clone.update_local_view(['summary'])
             if clone:
                 if clone.power_state() == 'poweredOn':
                     self.log.debug('CLONE(%s) POWEROFF STARTING' % vm_name)
                     task = clone.power_off_task()
-                    while not done(task):
+                    while not _task_done(task):
                         task = (yield task)
                     self.log.debug('CLONE(%s) POWEOFF DONE' % vm_name)
                 self.log.debug('CLONE(%s) DELETE STARTING' % vm_name)
                 task = clone.delete_vm_task()
-                while not done(task):
+                while not _task_done(task):
                     task = (yield task)
                 self.log.debug('CLONE(%s) DELETE DONE' % vm_name)
 
         # Use the specified target datastore or pick one automagically based on the placement strategy
         datastore=instance.get('datastore', None)
-        if not datastore:
+        placed = not datastore
+        if placed:
             placement_strategy = instance.get('placement', 'random')
             datastore=place_vm(base_vm, placement_strategy=placement_strategy)
 
-        cluster = instance.get('cluster', None)
+        try:
+            # The same placement is typically used for a whole batch of clones,
+            # so resolve it only once
+            resource_pool = self._get_entity('ResourcePool', instance.get('resource_pool', None))
+            cluster = self._get_entity('ComputeResource', instance.get('cluster', None), ['resourcePool'])
+            folder = self._get_entity('Folder', instance.get('folder', None))
 
-        self.log.debug('CLONE(%s) CLONE STARTING' % vm_name)
-        task = base_vm.clone_vm_task(vm_name, linked_clone=False, datastore=datastore, resource_pool=instance.get('resource_pool', None), folder=instance.get('folder'), cluster=cluster)
-        while not done(task):
-            task = (yield task)
-        if task.info.state != 'success':
-            raise TaskFailedError('CLONE(%s) failed with error: %r Details: %r' % (vm_name, task.info.error.localizedMessage, task.info.error.fault))
+            self.log.debug('CLONE(%s) CLONE STARTING' % vm_name)
+            task = base_vm.clone_vm_task(vm_name, linked_clone=False, datastore=datastore, resource_pool=resource_pool, folder=folder, cluster=cluster)
+            while not _task_done(task):
+                task = (yield task)
+            if task.info.state != 'success':
+                raise TaskFailedError('CLONE(%s) failed with error: %r Details: %r' % (vm_name, task.info.error.localizedMessage, task.info.error.fault))
+        except Exception:
+            if placed:
+                # The failed clone does not use the space after all
+                self._reserve_space(datastore, -base_vm.size)
+            raise
         self.log.debug('CLONE(%s) CLONE DONE' % vm_name)
 
-        clone = self.vim.find_vm_by_name(vm_name)
+        # Find if any new disks or NICs need to be added to the VM
+        hardware = instance.get('hardware', None) or {}
+        disks = _numbered_values(hardware, 'disk')
+        nics = _numbered_values(hardware, 'nic')
+
+        # The clone task gives the reference to the new VM. New disks are
+        # placed based on the existing devices, so fetch the config right away.
+        properties = ['config'] if disks else None
+        if getattr(task.info, 'result', None):
+            clone = self.vim.object_from_mor(task.info.result, properties)
+        else:
+            clone = self.vim.find_vm_by_name(vm_name, properties)
         assert clone, 'Could not find vm %s after cloning. Must not happen. Ever.' % (vm_name)
 
         # Reconfigure the VM hardware as specified
-        hardware = instance.get('hardware', None)
         if hardware:
-            # Find if any new disks or NICs need to be added to the VM
-            disks = [hardware.get('disk%d' % x) for x in xrange(10) if hardware.get('disk%d' % x)]
-            nics = [hardware.get('nic%d' % x) for x in xrange(10) if hardware.get('nic%d' % x)]
             spec = self.vim.create_object('VirtualMachineConfigSpec')
             if hardware.get('ram', None):
                 spec.memoryMB = int(hardware['ram'])
@@ -176,13 +317,13 @@ class VmOperations(object):
 
             self.log.debug('CLONE(%s) RECONFIG_VM STARTING' % vm_name)
             task = clone.reconfig_vm_task(spec=spec)
-            while not done(task):
+            while not _task_done(task):
                 task = (yield task)
             self.log.debug('CLONE(%s) RECONFIG_VM DONE' % vm_name)
 
         self.log.debug('CLONE(%s) POWERON STARTING' % vm_name)
         task = clone.power_on_task()
-        while not done(task):
+        while not _task_done(task):
             task = (yield task)
         clone.update_local_view(['summary'])
         if clone.power_state() != 'poweredOn':
@@ -218,7 +359,7 @@ class VmOperations(object):
             self.log.debug('CLONE(%s) WAITING FOR GUEST TOOLS TO START' % (vm_name))
             task = clone
             tool_wait_started = time.time()
-            while not guest_tool_running(task):
+            while not _guest_tools_running(task):
                 task = (yield task)
                 if time.time() - tool_wait_started > 60.0:
                     raise TimeoutError('guest tools have not started in 60 seconds')
@@ -227,23 +368,18 @@ class VmOperations(object):
 
         self.log.debug('CLONE(%s) WAITING FOR IP' % (vm_name))
         task = clone
-        while not got_ip(task):
+        while not _got_ip(task):
             task = (yield task)
         self.log.debug('CLONE(%s) GOT IP: %s' % (vm_name, task.summary.guest.ipAddress))
         instance['ipv4'] = task.summary.guest.ipAddress
 
         self.log.debug('CLONE(%s) SNAPSHOT STARTING' % vm_name)
         task = clone.create_snapshot_task('pristine', memory=True)
-        while not done(task):
+        while not _task_done(task):
             task = (yield task)
         self.log.debug('CLONE(%s) SNAPSHOT DONE' % vm_name)
 
     def create_snapshot(self, instance, name=None, description=None, memory=False):
-        def done(task):
-            return (hasattr(task, 'info') and
-                    (task.info.state == 'success' or
-                     task.info.state == 'error'))
-
         vm_name = instance['vm_name']
         vm = instance['vm']
         if not vm:
@@ -253,7 +389,7 @@ class VmOperations(object):
 
         self.log.debug('CREATE-SNAPSHOT(%s) STARTING' % vm_name)
         task = vm.create_snapshot_task(name, description, memory)
-        while not done(task):
+        while not _task_done(task):
             task = (yield task)
         self.log.debug('CREATE-SNAPSHOT(%s) DONE' % vm_name)
 
@@ -269,15 +405,6 @@ class VmOperations(object):
 
         @return: generator function
         """
-        def done(task):
-            return (hasattr(task, 'info') and
-                    (task.info.state == 'success' or
-                     task.info.state == 'error'))
-
-        def got_ip(task):
-            return (hasattr(task, 'summary') and
-                    getattr(task.summary.guest, 'ipAddress', None))
-
         vm_name = instance['vm_name']
         vm = instance['vm']
         if not vm:
@@ -293,24 +420,19 @@ class VmOperations(object):
             task = snapshots[0].snapshot.revert_to_snapshot_task()
         else:
             task = vm.revert_to_current_snapshot_task()
-        while not done(task):
+        while not _task_done(task):
             task = (yield task)
         self.log.debug('REVERT(%s) DONE' % vm_name)
 
         if wait_for_ip:
             self.log.debug('REVERT(%s) WAITING FOR IP' % (vm_name))
             task = vm
-            while not got_ip(task):
+            while not _got_ip(task):
                 task = (yield task)
             self.log.debug('REVERT(%s) GOT IP: %s' % (vm_name, task.summary.guest.ipAddress))
             instance['ipv4'] = task.summary.guest.ipAddress
 
     def remove_snapshot(self, instance, name=None):
-        def done(task):
-            return (hasattr(task, 'info') and
-                    (task.info.state == 'success' or
-                     task.info.state == 'error'))
-
         vm_name = instance['vm_name']
         vm = instance['vm']
         if not vm:
@@ -323,7 +445,7 @@ class VmOperations(object):
         if len(snapshots) != 1:
             raise InvalidParameterError('there must be one, and only one, snapshot with the name %r' % name)
         task = snapshots[0].snapshot.remove_snapshot_task(remove_children=True)
-        while not done(task):
+        while not _task_done(task):
             task = (yield task)
         self.log.debug('REMOVE-SNAPSHOT(%s) DONE' % vm_name)
 
@@ -337,11 +459,6 @@ class VmOperations(object):
 
         @return: generator function
         """
-        def done(task):
-            return (hasattr(task, 'info') and
-                    (task.info.state == 'success' or
-                     task.info.state == 'error'))
-
         vm_name = instance['vm_name']
         vm = instance['vm']
         if not vm:
@@ -352,7 +469,7 @@ class VmOperations(object):
         if vm.power_state() == 'poweredOff' and not off:
             self.log.debug('POWERON(%s) STARTING', vm_name)
             task = vm.power_on_task()
-            while not done(task):
+            while not _task_done(task):
                 task = (yield task)
             vm.update_local_view(['summary'])
             if vm.power_state() != 'poweredOn':
@@ -361,7 +478,7 @@ class VmOperations(object):
         elif vm.power_state() == 'poweredOn' and off:
             self.log.debug('POWEROFF(%s) STARTING', vm_name)
             task = vm.power_off_task()
-            while not done(task):
+            while not _task_done(task):
                 task = (yield task)
             vm.update_local_view(['summary'])
             if vm.power_state() != 'poweredOff':
@@ -379,16 +496,17 @@ class VmOperations(object):
 
         @param instance: dict of the VM instance to delete
 
+        @note: the 'vm' key is removed from the instance
+
         @return: generator function
         """
-        def done(task):
-            return (hasattr(task, 'info') and
-                    (task.info.state == 'success' or
-                     task.info.state == 'error'))
-
         vm_name = instance['vm_name']
-        vm = instance['vm']
-        if not vm:
+        vm = instance.pop('vm')
+        if vm:
+            # The caller may have looked it up long before this operation
+            # got its turn, so get the current power state
+            vm.update_local_view(['summary'])
+        else:
             vm = self.vim.find_vm_by_name(vm_name, ['summary'])
         if not vm:
             raise InvalidParameterError('VM %s not found in vSphere, something is terribly wrong here' % vm_name)
@@ -396,7 +514,7 @@ class VmOperations(object):
         if vm.power_state() == 'poweredOn':
             self.log.debug('DELETE(%s) POWEROFF STARTING', vm_name)
             task = vm.power_off_task()
-            while not done(task):
+            while not _task_done(task):
                 task = (yield task)
             vm.update_local_view(['summary'])
             if vm.power_state() != 'poweredOff':
@@ -405,7 +523,7 @@ class VmOperations(object):
 
         self.log.debug('DELETE(%s) DELETE STARTING' % vm_name)
         task = vm.delete_vm_task()
-        while not done(task):
+        while not _task_done(task):
             task = (yield task)
         self.log.debug('DELETE(%s) DELETE DONE' % vm_name)
 
@@ -418,14 +536,12 @@ class VmOperations(object):
 
         @param instance: dict of the VM instance to update
 
+        @note: the 'vm' key is removed from the instance
+
         @return: generator function
         """
-        def done(task):
-            return (hasattr(task, 'summary') and
-                    getattr(task.summary.guest, 'ipAddress', None))
-
         vm_name = instance['vm_name']
-        vm = instance.get('vm')
+        vm = instance.pop('vm', None)
         if not vm:
             vm = self.vim.find_vm_by_name(vm_name)
         if not vm:
@@ -433,51 +549,122 @@ class VmOperations(object):
 
         self.log.debug("UPDATE-VM(%s) WAITING FOR IP" % (vm_name))
         task = vm
-        while not done(task):
+        while not _got_ip(task):
             task = (yield task)
         self.log.debug("UPDATE-VM(%s) GOT IP: %s" % (vm_name, task.summary.guest.ipAddress))
         instance['ipv4'] = task.summary.guest.ipAddress
 
-    def run_on_instances(self, instances, operation, args=None):
+    def run_on_instances(self, instances, operation, args=None, max_parallel=None):
         """
         Run the specified operations in parallel on all the instances
 
         @param instances: a dict of instance_id -> instance_dict pairs
         @param operation: function to run on each instance
         @param args: dict of named arguments to pass to 'operation'
+        @param max_parallel: maximum number of operations running at the
+                             same time, the rest wait for a free slot.
+                             None (the default) runs all of them at once.
 
         @note: sets an 'error' key in the instance with the traceback
                in case of errors
+        @note: the instances are copied shallowly, operations may only set
+               top-level keys and must not modify nested values
         """
         if not args:
             args = {}
         ops = {}
         tasks = {}
         updated_instances = dict()
+        pending = collections.deque()
         for instance_id,instance_dict in instances.iteritems():
-            instance_copy = copy.copy(instance_dict)
+            instance_copy = dict(instance_dict)
             updated_instances[instance_id] = instance_copy
-            ops[instance_id] = operation(instance_copy, **args)
-            tasks[instance_id] = None
+            pending.append(instance_id)
+
+        def start_pending():
+            started = []
+            while pending and (max_parallel is None or len(ops) < max_parallel):
+                instance_id = pending.popleft()
+                ops[instance_id] = operation(updated_instances[instance_id], **args)
+                tasks[instance_id] = None
+                started.append(instance_id)
+            return started
+
+        started = start_pending()
+        last_resumed = {}
         next_report = time.time() + 10.0
-        while ops:
-            if any(tasks.itervalues()):
-                _,tasks = self.vim.update_many_objects(tasks)
-            for instance_id in list(ops):
-                try:
-                    tasks[instance_id] = ops[instance_id].send(tasks[instance_id])
-                except StopIteration:
-                    del tasks[instance_id]
-                    del ops[instance_id]
-                except KeyboardInterrupt:
-                    raise
-                except Exception, err:
-                    self.log.error('%s failed', instance_id)
-                    updated_instances[instance_id]['error'] = traceback.format_exc()
-                    del tasks[instance_id]
-                    del ops[instance_id]
-            if time.time() >= next_report:
-                self.log.debug('%d instances still waiting', len(ops))
-                next_report = time.time() + 10.0
-            time.sleep(2)
+        interval = self.vim.task_poll_interval
+        with _maybe_profile():
+            # The server pushes the changes of the objects the operations wait
+            # for, falling back to polling them on servers before vSphere 4.1
+            watcher = self.vim.property_watcher()
+            try:
+                while ops:
+                    ready = list(ops)
+                    if started:
+                        # Get the operations that just got a slot going at once
+                        ready = started
+                    elif watcher:
+                        watcher.watch(tasks.values())
+                        if any(watcher.is_watched(x) for x in tasks.itervalues()):
+                            changed = set(id(x) for x in watcher.wait(self.vim.task_poll_interval_max))
+                            # Only advance the operations whose object has changed,
+                            # or all of them when the wait timed out. The ones not
+                            # resumed for a while are advanced too so that they can
+                            # check their own time limits while others keep changing.
+                            if changed:
+                                stale = time.time() - self.vim.task_poll_interval_max
+                                ready = [x for x in ready if id(tasks[x]) in changed or
+                                         not watcher.is_watched(tasks[x]) or
+                                         last_resumed.get(x, 0) <= stale]
+                        else:
+                            # Nothing to wait for on the server
+                            time.sleep(self.vim.task_poll_interval)
+                    elif any(tasks.itervalues()):
+                        try:
+                            _,tasks = self.vim.update_many_objects(tasks)
+                        except ObjectNotFoundError as e:
+                            # The objects of these operations are gone, so
+                            # they would never finish. Poll the rest again.
+                            for instance_id in e.keys:
+                                self.log.error('%s failed', instance_id)
+                                updated_instances[instance_id]['error'] = traceback.format_exc()
+                                del tasks[instance_id]
+                                del ops[instance_id]
+                            ready = []
+                    progress = False
+                    for instance_id in ready:
+                        task = tasks[instance_id]
+                        last_resumed[instance_id] = time.time()
+                        try:
+                            tasks[instance_id] = ops[instance_id].send(task)
+                            # A new object to wait for means the operation moved on
+                            if tasks[instance_id] is not task:
+                                progress = True
+                        except StopIteration:
+                            del tasks[instance_id]
+                            del ops[instance_id]
+                            progress = True
+                        except KeyboardInterrupt:
+                            raise
+                        except Exception:
+                            self.log.error('%s failed', instance_id)
+                            updated_instances[instance_id]['error'] = traceback.format_exc()
+                            del tasks[instance_id]
+                            del ops[instance_id]
+                            progress = True
+                    started = start_pending()
+                    if time.time() >= next_report:
+                        self.log.debug('%d instances still waiting, %d queued', len(ops), len(pending))
+                        next_report = time.time() + 10.0
+                    if not ops or watcher:
+                        continue
+                    # Poll quickly while the operations advance, back off when they wait
+                    if progress:
+                        interval = self.vim.task_poll_interval
+                    time.sleep(interval)
+                    interval = min(interval * 1.5, self.vim.task_poll_interval_max)
+            finally:
+                if watcher:
+                    watcher.close()
         return updated_instances
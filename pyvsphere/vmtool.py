@@ -18,18 +18,23 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+from __future__ import print_function
+
+import argparse
 import logging
 import os
-import optparse
 import sys
 import time
 
 from vim25 import Vim, VirtualMachineSnapshot, InvalidParameterError
 from vmops import VmOperations
 
+# Default number of VMs the batch commands process at the same time
+MAX_PARALLEL = 25
+
 
 class VmTool(object):
-    def __init__(self, vi_url, vi_username, vi_password, vi_version, debug=False):
+    def __init__(self, vi_url, vi_username, vi_password, vi_version, debug=False, vi_session_file=None):
         self.debug = debug
         self.log = logging.getLogger('pyvsphere.vmtool')
         if self.debug:
@@ -41,30 +46,55 @@ class VmTool(object):
         self.vi_password = vi_password or os.environ.get('VI_PASSWORD')
         assert self.vi_password, 'either the enviroment variable VI_PASSWORD or the password parameter needs to be specified'
         self.vi_version = vi_version or os.environ.get('VI_VERSION')
+        self.vi_session_file = vi_session_file or os.environ.get('VI_SESSIONFILE')
 
         self.vim = Vim(self.vi_url, debug=False, version=self.vi_version)
         self.log.debug('CONNECTION complete')
-        self.vim.login(self.vi_username, self.vi_password)
-        self.log.debug('LOGIN complete')
+        if self.resume_session():
+            self.log.debug('SESSION resumed')
+        else:
+            self.vim.login(self.vi_username, self.vi_password)
+            self.log.debug('LOGIN complete')
+            self.save_session()
 
         self.vmops = VmOperations(self.vim)
 
+    def resume_session(self):
+        """ Continue the session saved in the session file, if there is one """
+        if not self.vi_session_file or not os.path.exists(self.vi_session_file):
+            return False
+        with open(self.vi_session_file) as f:
+            cookie = f.read().strip()
+        return bool(cookie) and self.vim.resume_session(cookie)
+
+    def save_session(self):
+        """ Save the session cookie for the next runs, readable only by the user """
+        if not self.vi_session_file:
+            return
+        cookie = self.vim.session_cookie()
+        if cookie:
+            fd = os.open(self.vi_session_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+            with os.fdopen(fd, 'w') as f:
+                f.write(cookie)
+
     def test(self, options):
         """ Placeholder for random hacking so --test has something to run """
-        print 'Status: 95% complete ...'
+        print('Status: 95% complete ...')
         time.sleep(10.0)
 
     def vm_names_from_options(self, options):
+        """ Return the tuple of VM names to process """
         if options.count == 1:
-            yield options.vm_name
-        else:
-            for i in range(options.count):
-                yield '%s-%02d' % (options.vm_name, i)
+            return (options.vm_name,)
+        return tuple('%s-%02d' % (options.vm_name, i) for i in range(options.count))
 
-    def clone_vms(self, options):
+    def clone_vms(self, options, vm_names):
         instances = dict()
-        for vm_name in self.vm_names_from_options(options):
+        # Find the old VMs to nuke in one go instead of in each clone operation
+        old_vms = self.vim.find_vms_by_names(vm_names, ['summary'])
+        for vm_name in vm_names:
             instance = dict(vm_name=vm_name,
+                            vm=old_vms.get(vm_name),
                             base_vm_name=options.base_image,
                             datastore_filter=options.datastore_filter,
                             folder=options.folder,
@@ -72,19 +102,24 @@ class VmTool(object):
                             cluster=options.cluster)
             instances[vm_name] = instance
         args = {'nuke_old': True}
-        return self.vmops.run_on_instances(instances, self.vmops.clone_vm, args)
+        return self.vmops.run_on_instances(instances, self.vmops.clone_vm, args,
+                                           max_parallel=options.max_parallel)
 
-    def delete_vms(self, options):
+    def delete_vms(self, options, vm_names):
         """ Delete a batch of VMs """
-        instances = dict((x, dict(vm_name=x, vm=None)) for x in self.vm_names_from_options(options))
-        return self.vmops.run_on_instances(instances, self.vmops.delete_vm)
+        vms = self.vim.find_vms_by_names(vm_names, ['summary'])
+        instances = dict((x, dict(vm_name=x, vm=vms.get(x))) for x in vm_names)
+        return self.vmops.run_on_instances(instances, self.vmops.delete_vm,
+                                           max_parallel=options.max_parallel)
 
-    def list_ips(self, options):
+    def list_ips(self, options, vm_names):
         """ List the IP addresses of a number of VMs """
-        instances = dict((x, dict(vm_name=x)) for x in self.vm_names_from_options(options))
-        updated_instances = self.vmops.run_on_instances(instances, self.vmops.update_vm)
+        vms = self.vim.find_vms_by_names(vm_names, ['summary'])
+        instances = dict((x, dict(vm_name=x, vm=vms.get(x))) for x in vm_names)
+        updated_instances = self.vmops.run_on_instances(instances, self.vmops.update_vm,
+                                                        max_parallel=options.max_parallel)
         for instance_id in updated_instances:
-            print '%s: %s' % (instance_id, updated_instances[instance_id]['ipv4'])
+            print('%s: %s' % (instance_id, updated_instances[instance_id]['ipv4']))
 
     def snapshot(self, options):
         vm = self.vim.find_vm_by_name(options.vm_name)
@@ -96,7 +131,7 @@ class VmTool(object):
         if snapshots:
             current_snapshot = VirtualMachineSnapshot(mor=vm.snapshot.currentSnapshot, vim=self.vim)
             for snapshot in snapshots:
-                print snapshot.name, '(CURRENT)' if snapshot.snapshot == current_snapshot else ''
+                print(snapshot.name, '(CURRENT)' if snapshot.snapshot == current_snapshot else '')
 
     def revert(self, options):
         vm = self.vim.find_vm_by_name(options.vm_name)
@@ -116,63 +151,71 @@ class VmTool(object):
         snapshotinfos[0].snapshot.revert_to_snapshot()
 
 def main():
-    parser = optparse.OptionParser('Usage: %prog [options]')
-    parser.add_option('--debug',
-                      action='store_true', dest='debug', default=False,
-                      help='Turn on noisy logging')
-    parser.add_option('--clone',
-                      action='store_true', dest='clone', default=False,
-                      help='Clone VMs from a base image')
-    parser.add_option('--snapshot',
-                      dest='snapshot', default=None,
-                      help='Take a snapshot with <name>')
-    parser.add_option('--list-snapshots',
-                      action='store_true', dest='list_snapshots', default=False,
-                      help='List snapshots for the VM')
-    parser.add_option('--revert',
-                      action='store_true', dest='revert', default=False,
-                      help='Revert to current snapshot')
-    parser.add_option('--remove-snapshot',
-                      dest='remove_snapshot', default=None,
-                      help='Take a snapshot <name>')
-    parser.add_option('--revert-to-snapshot',
-                      dest='revert_to_snapshot', default=None,
-                      help='Revert to snapshot <name>')
-    parser.add_option('--delete',
-                      action='store_true', dest='delete', default=False,
-                      help='Delete VMs')
-    parser.add_option('--list-ips',
-                      action='store_true', dest='list_ips', default=False,
-                      help='List IP addresses of VMs')
-    parser.add_option('--test',
-                      action='store_true', dest='test', default=False,
-                      help='do some testing craziness')
-    parser.add_option('--count', dest='count', type='int', default=1,
-                      help='Number of VMs to process')
-    parser.add_option('--base-image', dest='base_image',
-                      help='Name of the image to use as base for cloning')
-    parser.add_option('--datastore-filter', dest='datastore_filter', default='',
-                      help='place the clones VMs to datastores which contain the filter substring')
-    parser.add_option('--vm-name', dest='vm_name',
-                      help='Name of VM (used as a prefix in batch operations)')
-    parser.add_option('--folder', dest='folder', default='',
-                      help='destination folder for the clones, in the format of Data Center/vm/Any/Folder/Name')
-    parser.add_option('--resource-pool', dest='resource_pool', default='',
-                      help='resource pool for the clones. Defaults to the root pool if not specified.')
-    parser.add_option('--cluster', dest='cluster', default=None,
-                      help='cluster compute resource for the cloned VMs')
-    parser.add_option('--username', dest='vi_username', default=None,
-                      help='vSphere user name')
-    parser.add_option('--password', dest='vi_password', default=None,
-                      help='vSphere password')
-    parser.add_option('--url', dest='vi_url', default=None,
-                      help='vSphere URL (https://<your_server>/sdk)')
-    parser.add_option('--vsphere-version', dest='vi_version', default=None,
-                      help='vSphere version number)')
-    parser.add_option('-v', '--verbose',
-                      action='store_true', dest='verbose', default=False,
-                      help='keeps you well informed when running')
-    (options, args) = parser.parse_args()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--debug',
+                        action='store_true', dest='debug', default=False,
+                        help='Turn on noisy logging')
+    parser.add_argument('--clone',
+                        action='store_true', dest='clone', default=False,
+                        help='Clone VMs from a base image')
+    parser.add_argument('--snapshot',
+                        dest='snapshot', default=None,
+                        help='Take a snapshot with <name>')
+    parser.add_argument('--list-snapshots',
+                        action='store_true', dest='list_snapshots', default=False,
+                        help='List snapshots for the VM')
+    parser.add_argument('--revert',
+                        action='store_true', dest='revert', default=False,
+                        help='Revert to current snapshot')
+    parser.add_argument('--remove-snapshot',
+                        dest='remove_snapshot', default=None,
+                        help='Take a snapshot <name>')
+    parser.add_argument('--revert-to-snapshot',
+                        dest='revert_to_snapshot', default=None,
+                        help='Revert to snapshot <name>')
+    parser.add_argument('--delete',
+                        action='store_true', dest='delete', default=False,
+                        help='Delete VMs')
+    parser.add_argument('--list-ips',
+                        action='store_true', dest='list_ips', default=False,
+                        help='List IP addresses of VMs')
+    parser.add_argument('--test',
+                        action='store_true', dest='test', default=False,
+                        help='do some testing craziness')
+    parser.add_argument('--count', dest='count', type=int, default=1,
+                        help='Number of VMs to process')
+    parser.add_argument('--max-parallel', dest='max_parallel', type=int, default=MAX_PARALLEL,
+                        help='Maximum number of VMs to process at the same time (default %d)' % MAX_PARALLEL)
+    parser.add_argument('--base-image', dest='base_image',
+                        help='Name of the image to use as base for cloning')
+    parser.add_argument('--datastore-filter', dest='datastore_filter', default='',
+                        help='place the clones VMs to datastores which contain the filter substring')
+    parser.add_argument('--vm-name', dest='vm_name',
+                        help='Name of VM (used as a prefix in batch operations)')
+    parser.add_argument('--folder', dest='folder', default='',
+                        help='destination folder for the clones, in the format of Data Center/vm/Any/Folder/Name')
+    parser.add_argument('--resource-pool', dest='resource_pool', default='',
+                        help='resource pool for the clones. Defaults to the root pool if not specified.')
+    parser.add_argument('--cluster', dest='cluster', default=None,
+                        help='cluster compute resource for the cloned VMs')
+    parser.add_argument('--poll-interval-min', dest='poll_interval_min', type=float, default=None,
+                        help='shortest time in seconds between polls of the running tasks')
+    parser.add_argument('--poll-interval-max', dest='poll_interval_max', type=float, default=None,
+                        help='longest time in seconds between polls of the running tasks')
+    parser.add_argument('--username', dest='vi_username', default=None,
+                        help='vSphere user name')
+    parser.add_argument('--password', dest='vi_password', default=None,
+                        help='vSphere password')
+    parser.add_argument('--url', dest='vi_url', default=None,
+                        help='vSphere URL (https://<your_server>/sdk)')
+    parser.add_argument('--session-file', dest='vi_session_file', default=None,
+                        help='file to keep the vSphere session in between runs')
+    parser.add_argument('--vsphere-version', dest='vi_version', default=None,
+                        help='vSphere version number)')
+    parser.add_argument('-v', '--verbose',
+                        action='store_true', dest='verbose', default=False,
+                        help='keeps you well informed when running')
+    options = parser.parse_args()
 
     commands = ['clone', 'list_ips', 'delete', 'snapshot', 'list_snapshots',
                 'remove_snapshot', 'revert_to_snapshot', 'revert', 'test']
@@ -182,34 +225,45 @@ def main():
 
     assert options.vm_name, 'VM name needs to be specified with --vm_name <vm-name>'
 
-    vmtool = VmTool(options.vi_url, options.vi_username, options.vi_password, options.vi_version, options.verbose)
+    vmtool = VmTool(options.vi_url, options.vi_username, options.vi_password, options.vi_version, options.verbose,
+                    options.vi_session_file)
+    if options.poll_interval_min:
+        vmtool.vim.task_poll_interval = options.poll_interval_min
+    if options.poll_interval_max:
+        vmtool.vim.task_poll_interval_max = options.poll_interval_max
 
-    if options.clone:
-        vmtool.clone_vms(options)
+    # The same VMs are used by all the batch commands
+    vm_names = vmtool.vm_names_from_options(options)
+    try:
+        if options.clone:
+            vmtool.clone_vms(options, vm_names)
 
-    if options.list_ips:
-        vmtool.list_ips(options)
+        if options.list_ips:
+            vmtool.list_ips(options, vm_names)
 
-    if options.delete:
-        vmtool.delete_vms(options)
+        if options.delete:
+            vmtool.delete_vms(options, vm_names)
 
-    if options.snapshot:
-        vmtool.snapshot(options)
+        if options.snapshot:
+            vmtool.snapshot(options)
 
-    if options.list_snapshots:
-        vmtool.list_snapshots(options)
+        if options.list_snapshots:
+            vmtool.list_snapshots(options)
 
-    if options.remove_snapshot:
-        vmtool.remove_snapshot(options)
+        if options.remove_snapshot:
+            vmtool.remove_snapshot(options)
 
-    if options.revert_to_snapshot:
-        vmtool.revert_to_snapshot(options)
+        if options.revert_to_snapshot:
+            vmtool.revert_to_snapshot(options)
 
-    if options.revert:
-        vmtool.revert(options)
+        if options.revert:
+            vmtool.revert(options)
 
-    if options.test:
-        vmtool.test(options)
+        if options.test:
+            vmtool.test(options)
+    finally:
+        # The session may be resumed later, do not leave the views behind
+        vmtool.vim.destroy_views()
 
 if __name__ == '__main__':
     main()
@@ -7,6 +7,12 @@ setup(
     author_email = "<TBD>",
     description = "pyvsphere is a Python client for the VMware vSphere API",
     license = "Apache License, Version 2.0",
+    classifiers = [
+        'License :: OSI Approved :: Apache Software License',
+        'Programming Language :: Python :: 2',
+        'Programming Language :: Python :: Implementation :: CPython',
+        'Programming Language :: Python :: Implementation :: PyPy',
+        ],
     entry_points = {
         'console_scripts' : [
             'pyvsphere-tool = pyvsphere.vmtool:main',
@@ -0,0 +1,266 @@
+#
+# Tests for the VmOperations scheduler, run with: python -m unittest discover tests
+#
+# Copyright 2011-2012 F-Secure Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import time
+import unittest
+
+from pyvsphere.vim25 import ObjectNotFoundError, TaskFailedError
+from pyvsphere.vmops import VmOperations
+
+
+class FakeMor(object):
+    def __init__(self, value):
+        self._type = 'Task'
+        self.value = value
+
+
+class FakeInfo(object):
+    def __init__(self, state):
+        self.state = state
+
+
+class FakeTask(object):
+    def __init__(self, value, state='running'):
+        self.mor = FakeMor(value)
+        self.info = FakeInfo(state)
+
+
+class FakeWatcher(object):
+    """ Reports one watched task per wait as changed and finished """
+    def __init__(self, vim):
+        self.vim = vim
+        self.watched = {}
+
+    def watch(self, objects):
+        self.watched = dict((id(x), x) for x in objects if isinstance(x, FakeTask))
+
+    def is_watched(self, obj):
+        return id(obj) in self.watched
+
+    def wait(self, max_wait):
+        if not self.watched:
+            # Like PropertyWatcher, nothing to block on the server for
+            return []
+        for obj in self.watched.values():
+            if obj.mor.value not in self.vim.stuck:
+                time.sleep(self.vim.task_poll_interval)
+                obj.info.state = 'success'
+                return [obj]
+        time.sleep(max_wait)
+        return []
+
+    def close(self):
+        self.vim.watcher_closed = True
+
+
+class FakeVim(object):
+    """
+    Stands in for Vim in the scheduler: tasks finish after a given number
+    of polls, or on the first wait with the watcher
+    """
+    def __init__(self, use_watcher, polls_needed=2):
+        self.task_poll_interval = 0.001
+        self.task_poll_interval_max = 0.01
+        self.use_watcher = use_watcher
+        self.polls_needed = polls_needed
+        self.polls = {}
+        self.missing = set()
+        self.stuck = set()
+        self.watcher_closed = False
+
+    def property_watcher(self):
+        return FakeWatcher(self) if self.use_watcher else None
+
+    def update_many_objects(self, objects):
+        missing = [k for k, v in objects.items() if v and v.mor.value in self.missing]
+        if missing:
+            error = ObjectNotFoundError('gone')
+            error.keys = missing
+            raise error
+        updated = {}
+        for key, obj in objects.items():
+            if not obj:
+                updated[key] = obj
+                continue
+            polls = self.polls[obj.mor.value] = self.polls.get(obj.mor.value, 0) + 1
+            updated[key] = FakeTask(obj.mor.value,
+                                    'success' if polls >= self.polls_needed else 'running')
+        return True, updated
+
+
+class FakeDatastore(object):
+    def __init__(self, value, free_space):
+        self.mor = FakeMor(value)
+        self.name = value
+        self.summary = type('Summary', (object,), dict(freeSpace=free_space))()
+
+
+class FakeBaseVm(object):
+    size = 10
+
+    def __init__(self, datastores, error=None):
+        self.available_datastores = datastores
+        self.error = error
+
+    def clone_vm_task(self, *args, **kw):
+        if self.error:
+            raise self.error
+        return FakeTask('clone')
+
+
+class FakeOldVm(object):
+    def __init__(self):
+        self.state = 'poweredOn'
+        self.updated = []
+
+    def update_local_view(self, properties):
+        self.updated.append(properties)
+        self.state = 'poweredOff'
+
+    def power_state(self):
+        return self.state
+
+    def delete_vm_task(self):
+        return FakeTask('delete', state='success')
+
+
+class CloneVmTest(unittest.TestCase):
+    def clone(self, base_vm, **kw):
+        vmops = VmOperations(FakeVim(use_watcher=False))
+        vmops._base_vm_cache.add('base', base_vm)
+        self.instance = dict(vm_name='vm', base_vm_name='base', **kw)
+        operation = vmops.clone_vm(self.instance, nuke_old='vm' in kw)
+        return vmops, operation
+
+    def test_old_vm_refreshed_and_not_kept(self):
+        old_vm = FakeOldVm()
+        vmops, operation = self.clone(FakeBaseVm([FakeDatastore('ds', 100)]), vm=old_vm)
+        # Powered off in the meantime, so it is deleted right away
+        self.assertEqual(operation.next().mor.value, 'clone')
+        self.assertEqual(old_vm.updated, [['summary']])
+        self.assertNotIn('vm', self.instance)
+
+    def test_reservation_released_on_fault(self):
+        vmops, operation = self.clone(FakeBaseVm([FakeDatastore('ds', 100)],
+                                                 error=RuntimeError('fault')))
+        self.assertRaises(RuntimeError, operation.next)
+        self.assertEqual(vmops._reservations, {'ds': 0})
+
+    def test_reservation_released_on_failed_task(self):
+        vmops, operation = self.clone(FakeBaseVm([FakeDatastore('ds', 100)]))
+        task = operation.next()
+        self.assertEqual(vmops._reservations, {'ds': 10})
+        task.info.state = 'error'
+        task.info.error = type('Error', (object,), dict(localizedMessage='no', fault=None))()
+        self.assertRaises(TaskFailedError, operation.send, task)
+        self.assertEqual(vmops._reservations, {'ds': 0})
+
+
+class RunOnInstancesTest(unittest.TestCase):
+    def setUp(self):
+        self.running = 0
+        self.max_running = 0
+        self.finished = []
+
+    def operation(self, instance, steps=2):
+        """ Wait for a number of tasks in a row, like the real operations do """
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            for step in range(steps):
+                task = FakeTask('%s-%d' % (instance['name'], step))
+                while task.info.state != 'success':
+                    task = (yield task)
+            instance['done'] = True
+            self.finished.append(instance['name'])
+        finally:
+            self.running -= 1
+
+    def run_operations(self, vim, names=('a', 'b'), **kw):
+        vmops = VmOperations(vim)
+        instances = dict((x, dict(name=x)) for x in names)
+        return vmops.run_on_instances(instances, self.operation, **kw)
+
+    def test_polling(self):
+        result = self.run_operations(FakeVim(use_watcher=False))
+        self.assertEqual(sorted(result), ['a', 'b'])
+        self.assertTrue(all(x.get('done') for x in result.values()))
+
+    def test_watcher(self):
+        vim = FakeVim(use_watcher=True)
+        result = self.run_operations(vim)
+        self.assertTrue(all(x.get('done') for x in result.values()))
+        self.assertTrue(vim.watcher_closed)
+
+    def test_instances_are_copied(self):
+        vmops = VmOperations(FakeVim(use_watcher=False))
+        instances = {'a': dict(name='a')}
+        result = vmops.run_on_instances(instances, self.operation)
+        self.assertTrue(result['a']['done'])
+        self.assertNotIn('done', instances['a'])
+
+    def test_missing_object_fails_only_its_operation(self):
+        vim = FakeVim(use_watcher=False)
+        vim.missing.add('a-0')
+        result = self.run_operations(vim)
+        self.assertIn('ObjectNotFoundError', result['a']['error'])
+        self.assertNotIn('done', result['a'])
+        self.assertTrue(result['b']['done'])
+
+    def test_max_parallel(self):
+        for use_watcher in (False, True):
+            self.setUp()
+            result = self.run_operations(FakeVim(use_watcher), names=('a', 'b', 'c'),
+                                         max_parallel=1)
+            self.assertTrue(all(x.get('done') for x in result.values()))
+            self.assertEqual(self.max_running, 1)
+
+    def test_nothing_to_watch(self):
+        def operation(instance):
+            for _ in range(3):
+                yield None
+            instance['done'] = True
+        vim = FakeVim(use_watcher=True)
+        vim.task_poll_interval = 0.01
+        vmops = VmOperations(vim)
+        start = time.time()
+        result = vmops.run_on_instances({'a': {}}, operation)
+        self.assertTrue(result['a']['done'])
+        # Sleeps between the rounds instead of spinning
+        self.assertTrue(time.time() - start >= 0.02)
+
+    def test_busy_operations_do_not_starve_others(self):
+        vim = FakeVim(use_watcher=True)
+        # 'a' keeps changing for a while, 'b' waits for a task that never
+        # changes and gives up on its own once it gets resumed again
+        vim.stuck.add('b-0')
+        def operation(instance):
+            task = FakeTask(instance['name'] + '-0')
+            if instance['name'] == 'a':
+                for _ in range(50):
+                    task.info.state = 'running'
+                    task = (yield task)
+            else:
+                task = (yield task)
+            self.finished.append(instance['name'])
+        vmops = VmOperations(vim)
+        vmops.run_on_instances({'a': dict(name='a'), 'b': dict(name='b')}, operation)
+        self.assertEqual(self.finished, ['b', 'a'])
+
+
+if __name__ == '__main__':
+    unittest.main()